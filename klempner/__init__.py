@@ -1,2 +1,15 @@
 version_info = (0, 0, 3)
 version = '.'.join(str(c) for c in version_info)
+
+
+def session_for(service, pool_maxsize=None, pool_block=None):
+    """Retrieve a pooled HTTP session for `service`.
+
+    See :func:`klempner.session.session_for` for details.
+
+    """
+    # late import so that setup.py can import the version without
+    # the runtime requirements being installed
+    from klempner import session
+    return session.session_for(service, pool_maxsize=pool_maxsize,
+                               pool_block=pool_block)
@@ -1,4 +1,9 @@
 """Python 2/3 compatibility shim."""
+try:
+    from configparser import Error as ConfigParserError, RawConfigParser
+except ImportError:  # pragma: no cover
+    from ConfigParser import Error as ConfigParserError, RawConfigParser
+
 try:
     from io import StringIO
     from urllib.parse import quote, urlparse, urlunparse
@@ -12,15 +17,49 @@ try:
 except ImportError:  # pragma: no cover
     from collections import Iterable, Mapping
 
+try:
+    from importlib import metadata as _metadata
+except ImportError:  # pragma: no cover
+    _metadata = None
+    try:
+        import pkg_resources as _pkg_resources
+    except ImportError:
+        _pkg_resources = None
+
 try:
     TEXT_TYPES = (str, unicode)
 except NameError:  # pragma: no cover
     TEXT_TYPES = (str, )
 
+
+def iter_entry_points(group):
+    """Generate ``(name, load)`` pairs for the entry points in `group`.
+
+    `load` is a callable that imports and returns the advertised object.
+    Nothing is generated if entry point metadata is not available.
+
+    """
+    if _metadata is not None:
+        entry_points = _metadata.entry_points()
+        if hasattr(entry_points, 'select'):
+            entry_points = entry_points.select(group=group)
+        else:  # pragma: no cover
+            entry_points = entry_points.get(group, [])
+    elif _pkg_resources is not None:  # pragma: no cover
+        entry_points = _pkg_resources.iter_entry_points(group)
+    else:  # pragma: no cover
+        entry_points = []
+    for entry_point in entry_points:
+        yield entry_point.name, entry_point.load
+
+
 __all__ = [
+    'ConfigParserError',
     'Iterable',
+    'iter_entry_points',
     'Mapping',
     'quote',
+    'RawConfigParser',
     'StringIO',
     'TEXT_TYPES',
     'urlparse',
@@ -1,9 +1,9 @@
+import fnmatch
 import logging
 import os
+import re
 
-import requests
-
-from klempner import compat, errors, version
+from klempner import errors
 
 URL_SCHEME_MAP = {
     5672: 'amqp',  # https://www.rabbitmq.com/uri-spec.html
@@ -44,8 +44,22 @@ of this dictionary **at any time**.
 """
 
 
+NEAREST_DATACENTERS = 'nearest'
+"""Fail over to consul datacenters in order of network distance.
+
+Pass this as the `failover_datacenters` parameter to :func:`.configure`
+to calculate the failover order from consul's network coordinates.
+
+"""
+
+
 class DiscoveryMethod(object):
-    """Available discovery methods."""
+    """Built-in discovery methods.
+
+    Additional methods can be added by registering a backend with
+    :func:`klempner.discovery.register`.
+
+    """
 
     SIMPLE = 'simple'
     """Build URLs using service name as host name."""
@@ -56,12 +70,24 @@ class DiscoveryMethod(object):
     CONSUL_AGENT = 'consul+agent'
     """Build consul-based service URLs using a consul agent."""
 
+    CONSUL_DNS = 'consul+dns'
+    """Build consul-based service URLs from DNS SRV records."""
+
+    CONSUL_CONNECT = 'consul+connect'
+    """Build URLs for the local Consul Connect sidecar's upstreams."""
+
     ENV_VARS = 'environment'
     """Build URLs based on _HOST, _PORT, and _SCHEME environment variables."""
 
+    FILE = 'file'
+    """Build URLs from a JSON or INI file of service details."""
+
     K8S = 'kubernetes'
     """Build Kubernetes cluster-based service URLs."""
 
+    K8S_SRV = 'kubernetes+srv'
+    """Build Kubernetes cluster-based service URLs from DNS SRV records."""
+
     DEFAULT = SIMPLE
 
     UNSET = object()
@@ -72,11 +98,18 @@ class DiscoveryMethod(object):
 
     """
 
-    AVAILABLE = (CONSUL, CONSUL_AGENT, ENV_VARS, K8S, SIMPLE, UNSET)
+    AVAILABLE = (CONSUL, CONSUL_AGENT, CONSUL_CONNECT, CONSUL_DNS, ENV_VARS,
+                 FILE, K8S, K8S_SRV, SIMPLE, UNSET)
 
 
+_backend = None
 _discovery_method = DiscoveryMethod.UNSET
 _discovery_parameters = {}
+_overrides = {}
+_override_patterns = ()
+_route_cache = {}
+_ROUTE_CACHE_SIZE = 1024
+_NO_PATTERN_MATCHED = object()
 
 
 def reset():
@@ -90,14 +123,28 @@ def ensure_configured():
         configure_from_environment()
 
 
-def configure(discovery_method, **parameters):
+def configure(discovery_method, overrides=None, **parameters):
     """Configure the discovery method directly.
 
     :param discovery_method: method to use
+    :param overrides: optional mapping (or sequence of pairs) of
+        service name or glob pattern to the discovery method to use for
+        matching services instead of `discovery_method`.  The method is
+        either a name or a ``(name, parameters)`` tuple.  See
+        :func:`.get_service_backend` for how patterns are matched.
     :param parameters: parameters required for the selected
-        method
+        method.  The SRV-based methods accept an optional `nameserver`
+        parameter as either a ``(host, port)`` tuple or a ``host:port``
+        string.  The ``consul+agent`` and ``consul+dns`` methods accept
+        an optional `failover_datacenters` parameter that is either a
+        sequence of datacenter names (or a comma-separated string) or
+        :data:`.NEAREST_DATACENTERS`.  The ``consul+agent`` method also
+        accepts the `consistency`, `cache_max_age`, `tags`, and `filter`
+        parameters described by
+        :class:`~klempner.discovery.ConsulAgentBackend`.
     :raises: :exc:`klempner.errors.ConfigurationError` if a required
-        parameter is not provided
+        parameter is not provided or `discovery_method` is not a
+        registered discovery backend
 
     If `discovery_method` is :attr:`.DiscoveryMethod.UNSET`, then the
     current configuration is cleared and the library is reset to an
@@ -106,33 +153,65 @@ def configure(discovery_method, **parameters):
     on the current environment variables.
 
     """
-    from klempner import url  # late import to avoid circular dependency
+    # late import to avoid circular dependency
+    from klempner import discovery, url
 
     logger = logging.getLogger(__package__).getChild('configure')
 
-    def require_parameter(name):
+    def require_parameter(method, method_parameters, name):
         try:
-            return parameters.pop(name)
+            return method_parameters.pop(name)
         except KeyError:
             logger.error('parameter %s is required by discovery method %s',
-                         name, discovery_method)
+                         name, method)
             raise errors.ConfigurationError(name, None)
 
+    def create_backend(method, method_parameters):
+        backend_class = discovery.get_backend(method)
+        created_parameters = {}
+        for name in backend_class.required_parameters:
+            created_parameters[name] = require_parameter(
+                method, method_parameters, name)
+        for name, default in backend_class.optional_parameters.items():
+            created_parameters[name] = method_parameters.pop(name, default)
+        created_parameters = backend_class.normalize_parameters(
+            created_parameters)
+        return backend_class(**created_parameters), created_parameters
+
     logger.debug('configuring for discovery_method %s with parameters=%r',
                  discovery_method, parameters)
+    backend = None
     incoming_parameters = {}
-    if discovery_method == DiscoveryMethod.CONSUL:
-        incoming_parameters['datacenter'] = require_parameter('datacenter')
-    elif discovery_method == DiscoveryMethod.CONSUL_AGENT:
-        incoming_parameters['datacenter'] = require_parameter('datacenter')
-    elif discovery_method == DiscoveryMethod.K8S:
-        incoming_parameters['namespace'] = require_parameter('namespace')
-    elif discovery_method == DiscoveryMethod.UNSET:
+    override_backends = {}
+    if discovery_method is DiscoveryMethod.UNSET:
         url._reset_cache()
-    elif discovery_method not in DiscoveryMethod.AVAILABLE:
-        raise errors.ConfigurationError('discovery_style', discovery_method)
-
-    global _discovery_method, _discovery_parameters
+    else:
+        backend, incoming_parameters = create_backend(discovery_method,
+                                                      parameters)
+        if isinstance(overrides, dict):
+            overrides = overrides.items()
+        created = {}  # share backends between patterns with one method
+        for pattern, method in overrides or ():
+            shared_parameters = None
+            if isinstance(method, tuple):
+                method, shared_parameters = method
+            key = (method, id(shared_parameters))
+            if key not in created:
+                method_parameters = dict(shared_parameters or {})
+                created[key], _ = create_backend(method, method_parameters)
+                if method_parameters:
+                    logger.warning(
+                        'discovery style %s does not accept additional '
+                        'parameters, %d extra parameters were passed for %s',
+                        method, len(method_parameters), pattern)
+            override_backends[pattern] = created[key]
+
+    global _backend, _discovery_method
+    previous_backends = _all_backends()
+    _backend = backend
+    _compile_overrides(override_backends)
+    for previous in previous_backends:
+        previous.close()
     if discovery_method is DiscoveryMethod.UNSET:
         logger.info('resetting/clearing configuration values')
     elif _discovery_method is DiscoveryMethod.UNSET:
@@ -168,39 +247,29 @@ def configure_from_environment():
     logger.debug('configuring from environment: discovery_method=%s',
                  new_method)
 
-    def require_envvar(name):
-        try:
-            return os.environ[name]
-        except KeyError:
-            logger.error(
-                'discovery method %s requires the %s environment variable',
-                new_method, name)
-            raise errors.ConfigurationError(name, None)
-
-    parameters = {}
-    if new_method == DiscoveryMethod.CONSUL:
-        parameters['datacenter'] = require_envvar('CONSUL_DATACENTER')
-    elif new_method == DiscoveryMethod.CONSUL_AGENT:
-        headers = {'User-Agent': '/'.join([__package__, version])}
-        try:
-            headers['Authorization'] = 'Bearer {}'.format(
-                os.environ['CONSUL_HTTP_TOKEN'])
-        except KeyError:
-            pass
-        parsed = compat.urlparse(require_envvar('CONSUL_AGENT_URL'))
-        url = compat.urlunparse((parsed[0], parsed[1], '/v1/agent/self', None,
-                                 None, None))
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        body = response.json()
-        parameters['datacenter'] = body['Config']['Datacenter']
-    elif new_method == DiscoveryMethod.K8S:
-        parameters['namespace'] = os.environ.get('KUBERNETES_NAMESPACE',
-                                                 'default')
-    elif new_method not in DiscoveryMethod.AVAILABLE:
-        raise errors.ConfigurationError('discovery_style', new_method)
-
-    configure(new_method, **parameters)
+    # late import to avoid circular dependency
+    from klempner import discovery
+    backend_class = discovery.get_backend(new_method)
+    parameters = backend_class.parameters_from_environment()
+
+    overrides = []
+    override_parameters = {}
+    for entry in os.environ.get('KLEMPNER_DISCOVERY_OVERRIDES', '').split(','):
+        pattern, _, method = entry.partition('=')
+        pattern, method = pattern.strip(), method.strip()
+        if not pattern:
+            continue
+        if not method:
+            logger.error('discovery override %r does not name a method',
+                         entry)
+            raise errors.ConfigurationError('KLEMPNER_DISCOVERY_OVERRIDES',
+                                            entry)
+        if method not in override_parameters:
+            override_parameters[method] = discovery.get_backend(
+                method).parameters_from_environment()
+        overrides.append((pattern, (method, override_parameters[method])))
+
+    configure(new_method, overrides=overrides, **parameters)
 
 
 def get_discovery_details():
@@ -210,3 +279,81 @@ def get_discovery_details():
 
     """
     return _discovery_method, _discovery_parameters.copy()
+
+
+def get_discovery_backend():
+    """Retrieve the configured discovery backend.
+
+    :returns: the :class:`klempner.discovery.Backend` instance or
+        :data:`None` if the library is not configured
+
+    """
+    return _backend
+
+
+def get_service_backend(service):
+    """Retrieve the discovery backend that resolves `service`.
+
+    :param str service: name of the service
+    :returns: the :class:`klempner.discovery.Backend` instance or
+        :data:`None` if the library is not configured
+
+    Overrides that name `service` exactly take precedence over glob
+    patterns.  Patterns are tried from the longest to the shortest
+    and the first match wins.  If no override matches, then the
+    backend from :func:`.get_discovery_backend` is used.  The outcome
+    of matching the patterns is remembered for each service name so
+    this is a single dictionary lookup once a service has been seen.
+    Services that do not match a pattern are remembered as such and
+    the default backend is read on every call so that a concurrent
+    :func:`.configure` never leaves a replaced backend in the cache.
+
+    """
+    route_cache = _route_cache
+    backend = route_cache.get(service)
+    if backend is None:
+        backend = _overrides.get(service)
+        if backend is not None:
+            return backend
+        if not _override_patterns:
+            return _backend
+        backend = _NO_PATTERN_MATCHED
+        for match, pattern_backend in _override_patterns:
+            if match(service):
+                backend = pattern_backend
+                break
+        if len(route_cache) >= _ROUTE_CACHE_SIZE:
+            route_cache.clear()
+        route_cache[service] = backend
+    if backend is _NO_PATTERN_MATCHED:
+        return _backend
+    return backend
+
+
+def _compile_overrides(override_backends):
+    """Build the lookup tables used by :func:`.get_service_backend`."""
+    global _override_patterns, _route_cache
+    _overrides.clear()
+    _route_cache = {}
+    patterns = []
+    for pattern, backend in override_backends.items():
+        if any(char in pattern for char in '*?['):
+            patterns.append((pattern, backend))
+        else:
+            _overrides[pattern] = backend
+    patterns.sort(key=lambda entry: len(entry[0]), reverse=True)
+    _override_patterns = tuple(
+        (re.compile(fnmatch.translate(pattern)).match, backend)
+        for pattern, backend in patterns)
+
+
+def _all_backends():
+    """Retrieve the configured backend and every override backend."""
+    backends = [] if _backend is None else [_backend]
+    for backend in _overrides.values():
+        if backend not in backends:
+            backends.append(backend)
+    for _, backend in _override_patterns:
+        if backend not in backends:
+            backends.append(backend)
+    return backends
@@ -0,0 +1,423 @@
+"""Consul agent API client used by the consul discovery backends.
+
+The functions in this module send requests to the agent named by
+:envvar:`CONSUL_AGENT_URL` using the shared HTTP session and cache
+their results in the shared discovery caches (see
+:class:`klempner.url.State`).
+
+"""
+from __future__ import unicode_literals
+
+import itertools
+import logging
+import math
+import os
+import time
+
+from klempner import compat, config, url
+
+
+class ConsulServiceRecord(object):
+    """Compact representation of a consul catalog entry.
+
+    :param str name: name of the service
+    :param str datacenter: datacenter that the service is registered in
+    :param int port: service port
+    :param str scheme: optional URL scheme to use.  If it is omitted,
+        then the port is looked up in
+        :data:`klempner.config.URL_SCHEME_MAP` whenever the network
+        portion is read so changes to the mapping take effect
+        immediately.
+
+    Only the fields that are used to build URLs are retained from the
+    catalog entry.  The formatted URL prefix is cached by
+    :mod:`klempner.url` for each network portion so cache hits do not
+    re-format anything.
+
+    The freshness of the response that the record was created from is
+    retained as well.  `last_contact` is the number of seconds since the
+    answering server heard from the leader (``X-Consul-LastContact``),
+    `age` is the number of seconds that the response spent in the
+    agent's cache (``Age``), and `fetched_at` is when the record was
+    created.  :attr:`staleness` combines them into a single estimate.
+
+    """
+
+    __slots__ = ('name', 'datacenter', 'port', 'scheme', 'host',
+                 'last_contact', 'age', 'fetched_at', 'node', 'zone',
+                 '_port')
+
+    def __init__(self, name, datacenter, port, scheme=None, last_contact=None,
+                 age=None, host=None, node=None, zone=None):
+        self.name = name
+        self.datacenter = datacenter
+        self.port = port
+        self.scheme = scheme
+        if host is None:
+            host = '{0}.service.{1}.consul'.format(name, datacenter)
+        self.host = host
+        self._port = str(port)
+        self.last_contact = last_contact
+        self.age = age
+        self.fetched_at = time.time()
+        self.node = node
+        self.zone = zone
+
+    @classmethod
+    def from_catalog_entry(cls, entry, headers=None):
+        """Create a record from a ``/v1/catalog/service`` entry.
+
+        :param dict entry: a single entry from the catalog response
+        :param headers: optional response headers to retrieve the
+            ``X-Consul-LastContact`` and ``Age`` values from
+        :rtype: ConsulServiceRecord
+
+        The scheme is taken from the ``protocol`` service metadata if
+        it is present.  Otherwise the port is looked up in
+        :data:`klempner.config.URL_SCHEME_MAP` when the network portion
+        is read.
+
+        """
+        port = entry['ServicePort']
+        last_contact, age = _response_age(headers)
+        return cls(entry['ServiceName'], entry['Datacenter'], port,
+                   _service_protocol(entry.get('ServiceMeta')),
+                   last_contact=last_contact, age=age)
+
+    @classmethod
+    def from_health_entry(cls, entry, headers=None, zone_key='zone',
+                          use_address=True):
+        """Create a record from a ``/v1/health/service`` entry.
+
+        :param dict entry: a single entry from the health response
+        :param headers: optional response headers to retrieve the
+            ``X-Consul-LastContact`` and ``Age`` values from
+        :param str zone_key: node metadata key that holds the zone
+        :param bool use_address: use the address of the service
+            instance as the host instead of the service's DNS name
+        :rtype: ConsulServiceRecord
+
+        Unlike :meth:`from_catalog_entry`, the host is the address of
+        the service instance unless `use_address` is disabled.
+
+        """
+        node, service = entry['Node'], entry['Service']
+        port = service['Port']
+        last_contact, age = _response_age(headers)
+        host = None
+        if use_address:
+            host = service.get('Address') or node['Address']
+        return cls(service['Service'], node['Datacenter'], port,
+                   _service_protocol(service.get('Meta')),
+                   last_contact=last_contact, age=age, host=host,
+                   node=node['Node'],
+                   zone=(node.get('Meta') or {}).get(zone_key))
+
+    @property
+    def network_portion(self):
+        """The ``(scheme, host, port)`` tuple used to build URLs."""
+        scheme = self.scheme or config.URL_SCHEME_MAP.get(self.port, 'http')
+        return scheme, self.host, self._port
+
+    @property
+    def staleness(self):
+        """Estimated age of the record in seconds.
+
+        This is the sum of the consul server's last contact with the
+        leader, the time that the response was cached by the agent, and
+        the time since the record was created.
+
+        """
+        return ((self.last_contact or 0) + (self.age or 0) +
+                (time.time() - self.fetched_at))
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(
+            self.__class__.__name__,
+            url._format_network_portion(self.network_portion))
+
+
+class ConsulInstanceSet(object):
+    """Healthy instances of a service ordered by locality.
+
+    :param records: :class:`.ConsulServiceRecord` instance for each
+        healthy service instance
+    :param str node: name of the local consul node
+    :param str zone: zone that the local consul node is in
+    :param int spillover_threshold: minimum number of instances that
+        a locality needs before it is used exclusively
+
+    The instances are grouped into same-node, same-zone, and all
+    instances when the set is created.  The first group that has at
+    least `spillover_threshold` instances is used for every selection
+    so cache hits do not re-sort anything.
+
+    Every record in a set is created from the same health response so
+    the freshness attributes of :class:`.ConsulServiceRecord` are
+    available on the set as well.
+
+    """
+
+    __slots__ = ('records', 'selected', '_counter')
+
+    def __init__(self, records, node=None, zone=None, spillover_threshold=1):
+        self.records = tuple(records)
+        threshold = max(spillover_threshold, 1)
+        same_node = [r for r in self.records if node and r.node == node]
+        same_zone = [r for r in self.records if zone and r.zone == zone]
+        for candidates in (same_node, same_zone):
+            if len(candidates) >= threshold:
+                self.selected = tuple(candidates)
+                break
+        else:
+            self.selected = self.records
+        self._counter = itertools.count()
+
+    def next_record(self):
+        """Select the next preferred instance in round-robin order.
+
+        :rtype: ConsulServiceRecord
+
+        """
+        return self.selected[next(self._counter) % len(self.selected)]
+
+    @property
+    def last_contact(self):
+        """See :attr:`.ConsulServiceRecord.last_contact`."""
+        return self.records[0].last_contact
+
+    @property
+    def age(self):
+        """See :attr:`.ConsulServiceRecord.age`."""
+        return self.records[0].age
+
+    @property
+    def fetched_at(self):
+        """See :attr:`.ConsulServiceRecord.fetched_at`."""
+        return self.records[0].fetched_at
+
+    @property
+    def staleness(self):
+        """See :attr:`.ConsulServiceRecord.staleness`."""
+        return self.records[0].staleness
+
+    def __repr__(self):
+        return '<{0} {1} of {2} instances>'.format(self.__class__.__name__,
+                                                   len(self.selected),
+                                                   len(self.records))
+
+
+def lookup_service(service, datacenters=(), params=(), headers=None):
+    """Retrieve the details of `service` from consul.
+
+    :param str service: name of the service to look up
+    :param datacenters: optional sequence of datacenters to
+        fail over to if the service has no healthy instances in the
+        agent's datacenter or a callable that returns one.  The
+        callable is only called if the service is not found locally.
+    :param params: optional sequence of additional query parameter
+        tuples such as ``('stale', '')`` or ``('tag', 'primary')``
+    :param dict headers: optional additional request headers
+    :returns: a :class:`.ConsulServiceRecord` for the first healthy
+        instance or :data:`None` if the service has no healthy
+        instances in any of the datacenters
+
+    The healthy instances are retrieved from the health endpoint so
+    that a datacenter where the service is registered but failing its
+    checks is skipped.  The record uses the service's DNS name as the
+    host and is cached regardless of which datacenter it was found in.
+
+    """
+
+    def load():
+        path = '/v1/health/service/{0}'.format(service)
+        response, body = _first_answer(
+            service, path, datacenters, [('passing', '')] + list(params),
+            headers)
+        if response is None:
+            return None
+        return ConsulServiceRecord.from_health_entry(
+            body[0], response.headers, use_address=False)
+
+    return url._state.load_once(url._state.discovery_cache, service, load)
+
+
+def lookup_instances(service, datacenters=(), params=(), headers=None,
+                     node=None, zone=None, zone_key='zone',
+                     spillover_threshold=1):
+    """Retrieve the healthy instances of `service` from consul.
+
+    :param str service: name of the service to look up
+    :param datacenters: optional sequence of datacenters to
+        fail over to if the service has no healthy instances in the
+        agent's datacenter or a callable that returns one
+    :param params: optional sequence of additional query parameter
+        tuples
+    :param dict headers: optional additional request headers
+    :param str node: name of the local consul node
+    :param str zone: zone that the local consul node is in
+    :param str zone_key: node metadata key that holds the zone
+    :param int spillover_threshold: see :class:`.ConsulInstanceSet`
+    :returns: a :class:`.ConsulInstanceSet` or :data:`None` if the
+        service has no healthy instances in any of the datacenters
+
+    """
+
+    def load():
+        path = '/v1/health/service/{0}'.format(service)
+        response, body = _first_answer(
+            service, path, datacenters, [('passing', '')] + list(params),
+            headers)
+        if response is None:
+            return None
+        return ConsulInstanceSet(
+            [ConsulServiceRecord.from_health_entry(
+                entry, response.headers, zone_key) for entry in body],
+            node=node, zone=zone, spillover_threshold=spillover_threshold)
+
+    return url._state.load_once(url._state.discovery_cache,
+                                ('instances', service), load)
+
+
+def _first_answer(service, path, datacenters, params, headers):
+
+    def candidates():
+        yield None
+        for datacenter in (datacenters()
+                           if callable(datacenters) else datacenters):
+            yield datacenter
+
+    for datacenter in candidates():
+        response = agent_response(path, datacenter=datacenter,
+                                  params=params, headers=headers)
+        body = response.json()
+        if body:
+            return response, body
+        logger = logging.getLogger(__package__).getChild('consul')
+        logger.debug('service %s not found in datacenter %s', service,
+                     datacenter or '(local)')
+    return None, None
+
+
+def nearest_datacenters(datacenter):
+    """Retrieve the datacenters ordered by estimated round trip time.
+
+    :param str datacenter: the local datacenter
+    :returns: the names of the other datacenters ordered by
+        increasing round trip time from `datacenter`
+    :rtype: list
+
+    The order is calculated from the network coordinates that
+    consul maintains for the servers in each datacenter and is
+    cached alongside the discovery details.
+
+    """
+
+    def load():
+        coordinates = {}
+        for entry in agent_request('/v1/coordinate/datacenters'):
+            coordinates[entry['Datacenter']] = [
+                node['Coord'] for node in entry.get('Coordinates') or []
+            ]
+
+        local = coordinates.get(datacenter, [])
+        distances = []
+        for name, remote in coordinates.items():
+            if name != datacenter:
+                rtts = sorted(
+                    _coordinate_distance(a, b)
+                    for a in local
+                    for b in remote)
+                median = rtts[len(rtts) // 2] if rtts else float('inf')
+                distances.append((median, name))
+        ordered = [name for _, name in sorted(distances)]
+        logger = logging.getLogger(__package__).getChild('consul')
+        logger.debug('datacenters ordered by distance from %s: %r',
+                     datacenter, ordered)
+        return ordered
+
+    return url._state.load_once(url._state.coordinate_cache, datacenter,
+                                load)
+
+
+def agent_request(path, datacenter=None):
+    """Send a GET request to the consul agent.
+
+    :param str path: API path to retrieve
+    :param str datacenter: optional datacenter to direct the
+        request to
+    :returns: the decoded JSON response body
+
+    """
+    return agent_response(path, datacenter=datacenter).json()
+
+
+def agent_response(path, datacenter=None, params=(), headers=None,
+                   timeout=None):
+    """Send a GET request to the consul agent.
+
+    :param str path: API path to retrieve
+    :param str datacenter: optional datacenter to direct the
+        request to
+    :param params: optional sequence of additional query parameter
+        tuples
+    :param dict headers: optional additional request headers
+    :param float timeout: optional number of seconds to wait for
+        the response
+    :returns: the successful :class:`requests.Response`
+
+    """
+    parsed = compat.urlparse(os.environ['CONSUL_AGENT_URL'])
+    agent_url = compat.urlunparse((parsed[0], parsed[1], path, '', '', ''))
+    request_headers = dict(headers or {})
+    if os.environ.get('CONSUL_HTTP_TOKEN'):
+        request_headers['Authorization'] = 'Bearer {0}'.format(
+            os.environ['CONSUL_HTTP_TOKEN'])
+    request_params = list(params)
+    if datacenter is not None:
+        request_params.append(('dc', datacenter))
+
+    response = url._state.session.get(agent_url, headers=request_headers,
+                                      params=request_params, timeout=timeout)
+    response.raise_for_status()
+    return response
+
+
+def _response_age(headers):
+    """Retrieve the consul freshness headers from `headers`.
+
+    :returns: a ``(last_contact, age)`` tuple in seconds where either
+        value is :data:`None` if the header is not present
+
+    """
+    headers = headers or {}
+    last_contact = headers.get('X-Consul-LastContact')
+    if last_contact is not None:
+        last_contact = int(last_contact) / 1000.0
+    age = headers.get('Age')
+    if age is not None:
+        age = int(age)
+    return last_contact, age
+
+
+def _service_protocol(meta):
+    """Return the URL scheme advertised in consul service metadata."""
+    return (meta or {}).get('protocol')
+
+
+def _coordinate_distance(a, b):
+    """Estimate the round trip time between two network coordinates.
+
+    :param dict a: consul network coordinate
+    :param dict b: consul network coordinate
+    :returns: the estimated round trip time in seconds
+    :rtype: float
+
+    This is the same calculation that consul uses.  See
+    https://www.consul.io/docs/internals/coordinates.html
+
+    """
+    distance = math.sqrt(sum((x - y)**2 for x, y in zip(a['Vec'], b['Vec'])))
+    distance += a['Height'] + b['Height']
+    adjusted = distance + a['Adjustment'] + b['Adjustment']
+    return adjusted if adjusted > 0 else distance
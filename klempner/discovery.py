@@ -0,0 +1,915 @@
+"""Discovery backends and the backend registry.
+
+Each discovery method is implemented by a :class:`.Backend` subclass
+that is registered by name.  :func:`klempner.config.configure` looks up
+the backend class, validates the parameters that it declares, and
+creates an instance whose :meth:`~.Backend.resolve` method is called
+directly when URLs are built.
+
+Backends can be added without modifying this library by calling
+:func:`.register` or by advertising the backend class in the
+``klempner.discovery`` entry point group:
+
+.. code-block:: python
+
+   setuptools.setup(
+      ...,
+      entry_points={
+         'klempner.discovery': ['docker = mypackage:DockerBackend'],
+      },
+   )
+
+"""
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import requests
+
+from klempner import compat, config, consul, dns, errors, url, version
+
+ENTRY_POINT_GROUP = 'klempner.discovery'
+"""Entry point group that discovery backends are loaded from."""
+
+_registry = {}
+
+
+def register(backend_class):
+    """Register a backend class under its :attr:`~.Backend.name`.
+
+    :param type backend_class: the :class:`.Backend` subclass to register
+    :returns: `backend_class` so that this can be used as a decorator
+
+    Registering a class with the same name as an existing backend
+    replaces the existing backend.
+
+    """
+    _registry[backend_class.name] = backend_class
+    return backend_class
+
+
+def get_backend(name):
+    """Retrieve the backend class registered as `name`.
+
+    :param str name: discovery method name
+    :rtype: type
+    :raises: :exc:`klempner.errors.ConfigurationError` if a backend
+        is not registered as `name` and cannot be loaded from the
+        ``klempner.discovery`` entry point group
+
+    """
+    try:
+        return _registry[name]
+    except (KeyError, TypeError):
+        pass
+
+    for entry_point_name, load in compat.iter_entry_points(ENTRY_POINT_GROUP):
+        if entry_point_name == name:
+            backend_class = load()
+            _registry[name] = backend_class
+            return backend_class
+
+    raise errors.ConfigurationError('discovery_style', name)
+
+
+def _require_envvar(discovery_method, name):
+    try:
+        return os.environ[name]
+    except KeyError:
+        logger = logging.getLogger(__package__).getChild(
+            'configure_from_environment')
+        logger.error(
+            'discovery method %s requires the %s environment variable',
+            discovery_method, name)
+        raise errors.ConfigurationError(name, None)
+
+
+def _parse_flag(value):
+    """Interpret a boolean parameter that may come from the environment."""
+    if isinstance(value, compat.TEXT_TYPES):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+class Backend(object):
+    """Base class for discovery backends.
+
+    :param parameters: the validated discovery parameters
+
+    Subclasses set :attr:`name`, declare the parameters that they
+    accept, and implement :meth:`resolve`.  The shared discovery state
+    (caches, HTTP session, DNS resolvers) is available as :attr:`state`.
+
+    """
+
+    name = None
+    """Discovery method name that the backend is registered as."""
+
+    required_parameters = ()
+    """Names of the parameters that :func:`.configure` requires."""
+
+    optional_parameters = {}
+    """Mapping of optional parameter name to its default value."""
+
+    rotating = False
+    """Does :meth:`resolve` spread calls over several instances?
+
+    :func:`klempner.url.build_urls` resolves each URL individually
+    for rotating backends instead of once per :meth:`snapshot`.
+
+    """
+
+    def __init__(self, **parameters):
+        self.parameters = parameters
+
+    @property
+    def state(self):
+        """The shared :class:`klempner.url.State` instance."""
+        return url._state
+
+    @classmethod
+    def normalize_parameters(cls, parameters):
+        """Validate and normalize the incoming parameters.
+
+        :param dict parameters: the required and optional parameters
+        :returns: the parameters to create the backend with
+        :rtype: dict
+        :raises: :exc:`klempner.errors.ConfigurationError` if a
+            parameter is invalid
+
+        """
+        return parameters
+
+    @classmethod
+    def parameters_from_environment(cls):
+        """Retrieve the configuration parameters from the environment.
+
+        :rtype: dict
+        :raises: :exc:`klempner.errors.ConfigurationError` if a
+            required environment variable is not set
+
+        """
+        return {}
+
+    def resolve(self, service):
+        """Discover the network location of `service`.
+
+        :param str service: name of the service to look up
+        :returns: a ``(scheme, host, port)`` tuple where `port` is
+            :data:`None` or a string
+        :rtype: tuple
+        :raises: :exc:`klempner.errors.ServiceNotFoundError` if the
+            service cannot be discovered
+
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """Release resources when the backend is replaced.
+
+        :func:`klempner.config.configure` calls this on the current
+        backend before switching to a new one.  Backends that start
+        background threads stop them here.
+
+        """
+
+    def after_fork(self):
+        """Reinitialize process-specific resources in a forked child.
+
+        Backends that own locks or background threads replace them
+        here.  Cached discovery results SHOULD be kept.
+
+        """
+
+    def snapshot(self, service):
+        """Retrieve a token that identifies the cached details for `service`.
+
+        :param str service: name of the service to look up
+
+        :func:`klempner.url.build_urls` re-resolves the service whenever
+        the returned object changes identity.  Backends whose results
+        only change when the library is reconfigured return
+        :data:`None`.
+
+        """
+        return None
+
+
+@register
+class SimpleBackend(Backend):
+    """Use the service name as the host name."""
+
+    name = config.DiscoveryMethod.SIMPLE
+
+    def resolve(self, service):
+        return 'http', service, None
+
+
+@register
+class ConsulBackend(Backend):
+    """Build consul DNS names without contacting consul."""
+
+    name = config.DiscoveryMethod.CONSUL
+    required_parameters = ('datacenter', )
+
+    @classmethod
+    def parameters_from_environment(cls):
+        return {'datacenter': _require_envvar(cls.name, 'CONSUL_DATACENTER')}
+
+    def resolve(self, service):
+        return ('http', '{0}.service.{1}.consul'.format(
+            service, self.parameters['datacenter']), None)
+
+
+class _ConsulFailoverMixin(object):
+    """Shared handling of the `failover_datacenters` parameter."""
+
+    @classmethod
+    def normalize_parameters(cls, parameters):
+        parameters = super(_ConsulFailoverMixin,
+                           cls).normalize_parameters(parameters)
+        failover = parameters['failover_datacenters'] or ()
+        if failover == config.NEAREST_DATACENTERS:
+            if 'CONSUL_AGENT_URL' not in os.environ:
+                logger = logging.getLogger(__package__).getChild('configure')
+                logger.error('failing over to the nearest datacenter '
+                             'requires the CONSUL_AGENT_URL environment '
+                             'variable')
+                raise errors.ConfigurationError('CONSUL_AGENT_URL', None)
+        else:
+            if isinstance(failover, compat.TEXT_TYPES):
+                failover = failover.split(',')
+            failover = tuple(name.strip() for name in failover if name.strip())
+        parameters['failover_datacenters'] = failover
+        return parameters
+
+    def failover_datacenters(self):
+        """Retrieve the consul datacenters to fail over to.
+
+        :returns: the datacenters to try, in order, if a service is not
+            found in the configured datacenter
+        :rtype: list
+
+        This is only called after the service is not found in the
+        configured datacenter.  If the nearest datacenters cannot be
+        retrieved from consul, then a warning is logged and there is
+        nothing to fail over to.
+
+        """
+        failover = self.parameters['failover_datacenters']
+        if failover == config.NEAREST_DATACENTERS:
+            try:
+                return consul.nearest_datacenters(
+                    self.parameters['datacenter'])
+            except (requests.RequestException, KeyError, ValueError) as error:
+                logger = logging.getLogger(__package__).getChild('discovery')
+                logger.warning('failed to retrieve the nearest datacenters '
+                               'to %s: %s', self.parameters['datacenter'],
+                               error)
+                return ()
+        return failover
+
+
+@register
+class ConsulAgentBackend(_ConsulFailoverMixin, Backend):
+    """Look up service details using a consul agent.
+
+    The catalog requests can be tuned with the optional parameters:
+
+    - `consistency` selects consul's ``stale`` or ``consistent``
+      consistency mode instead of the default mode
+    - `cache_max_age` enables agent caching and sets the number of
+      seconds that a cached response may be used for
+    - `tags` limits the results to service instances that have all of
+      the listed tags
+    - `filter` is a consul filter expression applied by the server
+
+    Setting `topology_aware` switches from the service's DNS name to the
+    addresses of the healthy service instances.  Instances on the local
+    `node` are preferred, then instances whose node metadata `zone_key`
+    matches the local `zone`, then any healthy instance.  A locality is
+    only used if it has at least `spillover_threshold` instances.  When
+    configured from the environment, the node name and zone are read
+    from the agent.
+
+    """
+
+    name = config.DiscoveryMethod.CONSUL_AGENT
+    required_parameters = ('datacenter', )
+    optional_parameters = {
+        'failover_datacenters': (),
+        'consistency': None,
+        'cache_max_age': None,
+        'tags': (),
+        'filter': None,
+        'topology_aware': False,
+        'node': None,
+        'zone': None,
+        'zone_key': 'zone',
+        'spillover_threshold': 1,
+    }
+    consistency_modes = ('default', 'stale', 'consistent')
+
+    def __init__(self, **parameters):
+        super(ConsulAgentBackend, self).__init__(**parameters)
+        self.rotating = parameters['topology_aware']
+        self.query_parameters = []
+        self.query_headers = {}
+        if parameters['consistency'] not in (None, 'default'):
+            self.query_parameters.append((parameters['consistency'], ''))
+        if parameters['cache_max_age'] is not None:
+            self.query_parameters.append(('cached', ''))
+            self.query_headers['Cache-Control'] = 'max-age={0}'.format(
+                parameters['cache_max_age'])
+        for tag in parameters['tags']:
+            self.query_parameters.append(('tag', tag))
+        if parameters['filter']:
+            self.query_parameters.append(('filter', parameters['filter']))
+
+    @classmethod
+    def normalize_parameters(cls, parameters):
+        parameters = super(ConsulAgentBackend,
+                           cls).normalize_parameters(parameters)
+        logger = logging.getLogger(__package__).getChild('configure')
+
+        consistency = parameters['consistency'] or None
+        if (consistency is not None
+                and consistency not in cls.consistency_modes):
+            logger.error('consistency must be one of %s',
+                         ', '.join(cls.consistency_modes))
+            raise errors.ConfigurationError('consistency', consistency)
+        parameters['consistency'] = consistency
+
+        max_age = parameters['cache_max_age']
+        if max_age is not None and max_age != '':
+            try:
+                max_age = int(max_age)
+            except ValueError:
+                max_age = -1
+            if max_age < 0:
+                logger.error('cache_max_age must be a non-negative integer')
+                raise errors.ConfigurationError('cache_max_age',
+                                                parameters['cache_max_age'])
+            if consistency == 'consistent':
+                logger.error('consul does not support agent caching with '
+                             'the consistent consistency mode')
+                raise errors.ConfigurationError('cache_max_age', max_age)
+        else:
+            max_age = None
+        parameters['cache_max_age'] = max_age
+
+        tags = parameters['tags'] or ()
+        if isinstance(tags, compat.TEXT_TYPES):
+            tags = tags.split(',')
+        parameters['tags'] = tuple(tag.strip() for tag in tags if tag.strip())
+        parameters['filter'] = parameters['filter'] or None
+
+        parameters['topology_aware'] = _parse_flag(
+            parameters['topology_aware'])
+        threshold = parameters['spillover_threshold']
+        try:
+            threshold = int(threshold)
+        except (TypeError, ValueError):
+            threshold = 0
+        if threshold < 1:
+            logger.error('spillover_threshold must be a positive integer')
+            raise errors.ConfigurationError('spillover_threshold',
+                                            parameters['spillover_threshold'])
+        parameters['spillover_threshold'] = threshold
+        parameters['zone_key'] = parameters['zone_key'] or 'zone'
+        return parameters
+
+    @classmethod
+    def parameters_from_environment(cls):
+        headers = {'User-Agent': '/'.join([__package__, version])}
+        try:
+            headers['Authorization'] = 'Bearer {}'.format(
+                os.environ['CONSUL_HTTP_TOKEN'])
+        except KeyError:
+            pass
+        parsed = compat.urlparse(_require_envvar(cls.name, 'CONSUL_AGENT_URL'))
+        agent_url = compat.urlunparse(
+            (parsed[0], parsed[1], '/v1/agent/self', None, None, None))
+        response = requests.get(agent_url, headers=headers)
+        response.raise_for_status()
+        body = response.json()
+        zone_key = os.environ.get('CONSUL_ZONE_KEY') or 'zone'
+        return {
+            'datacenter': body['Config']['Datacenter'],
+            'topology_aware': os.environ.get('CONSUL_TOPOLOGY_AWARE'),
+            'node': body['Config'].get('NodeName'),
+            'zone': (body.get('Meta') or {}).get(zone_key),
+            'zone_key': zone_key,
+            'spillover_threshold': os.environ.get(
+                'CONSUL_SPILLOVER_THRESHOLD', 1),
+            'failover_datacenters': os.environ.get(
+                'CONSUL_FAILOVER_DATACENTERS'),
+            'consistency': os.environ.get('CONSUL_CONSISTENCY'),
+            'cache_max_age': os.environ.get('CONSUL_CACHE_MAX_AGE'),
+            'tags': os.environ.get('CONSUL_SERVICE_TAGS'),
+            'filter': os.environ.get('CONSUL_SERVICE_FILTER'),
+        }
+
+    def resolve(self, service):
+        record = self.snapshot(service)
+        if record is None:  # service does not exist in consul
+            raise errors.ServiceNotFoundError(service)
+        if self.parameters['topology_aware']:
+            record = record.next_record()
+        return record.network_portion
+
+    def snapshot(self, service):
+        if self.parameters['topology_aware']:
+            return consul.lookup_instances(
+                service, self.failover_datacenters,
+                params=self.query_parameters, headers=self.query_headers,
+                node=self.parameters['node'], zone=self.parameters['zone'],
+                zone_key=self.parameters['zone_key'],
+                spillover_threshold=self.parameters['spillover_threshold'])
+        return consul.lookup_service(
+            service, self.failover_datacenters,
+            params=self.query_parameters, headers=self.query_headers)
+
+
+@register
+class ConsulConnectBackend(Backend):
+    """Route requests through the local Consul Connect sidecar proxy.
+
+    The upstreams of the sidecar proxy are read from the agent the
+    first time that a service is resolved.  After that, a background
+    thread watches the proxy registration with blocking queries and
+    swaps in a new mapping when the upstreams change so resolving a
+    service is a dictionary lookup.
+
+    The sidecar is identified by `proxy_id`.  If it is not set, then
+    the agent's services are searched for a ``connect-proxy`` whose
+    destination is `service_name` or for the only ``connect-proxy``
+    registered with the agent.
+
+    """
+
+    name = config.DiscoveryMethod.CONSUL_CONNECT
+    optional_parameters = {'proxy_id': None, 'service_name': None}
+    blocking_wait = 300
+    """Number of seconds that each blocking query waits for a change."""
+    retry_interval = 5.0
+    """Number of seconds to wait after a failed blocking query."""
+
+    def __init__(self, **parameters):
+        super(ConsulConnectBackend, self).__init__(**parameters)
+        self.logger = logging.getLogger(__package__).getChild('discovery')
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._content_hash = None
+        self._proxy_id = parameters['proxy_id']
+        self._upstreams = None
+        self._watcher = None
+
+    @classmethod
+    def normalize_parameters(cls, parameters):
+        parameters = super(ConsulConnectBackend,
+                           cls).normalize_parameters(parameters)
+        if 'CONSUL_AGENT_URL' not in os.environ:
+            logger = logging.getLogger(__package__).getChild('configure')
+            logger.error('discovery method %s requires the CONSUL_AGENT_URL '
+                         'environment variable', cls.name)
+            raise errors.ConfigurationError('CONSUL_AGENT_URL', None)
+        return parameters
+
+    @classmethod
+    def parameters_from_environment(cls):
+        return {
+            'proxy_id': os.environ.get('CONSUL_CONNECT_PROXY_ID'),
+            'service_name': os.environ.get('CONSUL_CONNECT_SERVICE'),
+        }
+
+    def resolve(self, service):
+        try:
+            scheme, host, port = self.snapshot(service)[service]
+        except KeyError:
+            raise errors.ServiceNotFoundError(service)
+        if scheme is None:
+            scheme = ('http' if port is None else
+                      config.URL_SCHEME_MAP.get(int(port), 'http'))
+        return scheme, host, port
+
+    def snapshot(self, service):
+        upstreams = self._upstreams
+        if upstreams is None:
+            with self._lock:
+                if self._upstreams is None:
+                    self._load()
+                upstreams = self._upstreams
+        return upstreams
+
+    def close(self):
+        self._stopped.set()
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        if self._watcher is not None:
+            self._start_watcher()
+
+    def _load(self):
+        if self._proxy_id is None:
+            self._proxy_id = self._find_proxy()
+        self._fetch(())
+        self._start_watcher()
+
+    def _start_watcher(self):
+        self._watcher = threading.Thread(target=self._watch,
+                                         name='klempner-consul-connect')
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def _find_proxy(self):
+        services = consul.agent_request('/v1/agent/services')
+        proxies = [
+            service for service in services.values()
+            if service.get('Kind') == 'connect-proxy'
+        ]
+        destination = self.parameters['service_name']
+        if destination is not None:
+            proxies = [
+                proxy for proxy in proxies
+                if proxy['Proxy'].get('DestinationServiceName') == destination
+            ]
+        if len(proxies) != 1:
+            self.logger.error('expected one connect-proxy for %s, found %d',
+                              destination or 'the agent', len(proxies))
+            raise errors.ConfigurationError('proxy_id', None)
+        return proxies[0]['ID']
+
+    def _fetch(self, params, timeout=None):
+        response = consul.agent_response(
+            '/v1/agent/service/{0}'.format(self._proxy_id), params=params,
+            timeout=timeout)
+        content_hash = response.headers.get('X-Consul-ContentHash')
+        if content_hash is not None and content_hash == self._content_hash:
+            return  # blocking query timed out without a change
+        upstreams = {}
+        for upstream in response.json()['Proxy'].get('Upstreams') or []:
+            if not upstream.get('LocalBindPort'):
+                continue  # unix socket upstreams cannot be used in URLs
+            upstreams[upstream['DestinationName']] = (
+                'http', upstream.get('LocalBindAddress') or '127.0.0.1',
+                str(upstream['LocalBindPort']))
+        self.logger.debug('connect proxy %s has upstreams %r',
+                          self._proxy_id, sorted(upstreams))
+        self._upstreams = upstreams
+        self._content_hash = content_hash
+
+    def _watch(self):
+        while not self._stopped.is_set():
+            if self._content_hash is None:
+                # agent does not support blocking queries, fall back to polling
+                self._stopped.wait(self.retry_interval)
+                params = []
+            else:
+                params = [('hash', self._content_hash),
+                          ('wait', '{0}s'.format(self.blocking_wait))]
+            try:
+                self._fetch(params, timeout=self.blocking_wait * 1.5)
+            except (requests.RequestException, KeyError, ValueError) as error:
+                self.logger.warning('failed to refresh connect proxy %s: %s',
+                                    self._proxy_id, error)
+                self._stopped.wait(self.retry_interval)
+
+
+class _SRVBackend(Backend):
+    """Shared implementation of the SRV-based backends."""
+
+    default_port = 53
+    rotating = True
+
+    @classmethod
+    def normalize_parameters(cls, parameters):
+        parameters = super(_SRVBackend, cls).normalize_parameters(parameters)
+        nameserver = parameters['nameserver']
+        if isinstance(nameserver, compat.TEXT_TYPES):
+            nameserver = dns.parse_address(nameserver, cls.default_port)
+        elif nameserver:
+            nameserver = tuple(nameserver)
+        parameters['nameserver'] = nameserver or cls.default_nameserver()
+        try:
+            parameters['min_ttl'] = float(parameters['min_ttl'])
+            if parameters['min_ttl'] < 0:
+                raise ValueError(parameters['min_ttl'])
+        except (TypeError, ValueError):
+            raise errors.ConfigurationError('min_ttl', parameters['min_ttl'])
+        return parameters
+
+    @classmethod
+    def default_nameserver(cls):
+        return '127.0.0.1', cls.default_port
+
+    def srv_names(self, service):
+        """Retrieve the SRV record names for `service`.
+
+        :returns: the names to query in order of preference
+        :rtype: collections.abc.Iterable
+
+        """
+        raise NotImplementedError()
+
+    def snapshot(self, service):
+        """Retrieve the cached SRV records for `service`.
+
+        :returns: the first non-empty :class:`list` of
+            :class:`klempner.dns.SRVRecord` instances or :data:`None`
+
+        A new list is returned whenever the records are re-queried
+        after their TTL expires.
+
+        """
+        for name in self.srv_names(service):
+            try:
+                records = self.lookup_srv(name)
+            except (errors.DNSError, ValueError, socket.error) as error:
+                logger = logging.getLogger(__package__).getChild('discovery')
+                logger.error('failed to look up %s: %s', name, error)
+                raise errors.DiscoveryError(service, error)
+            if records:
+                return records
+        return None
+
+    def lookup_srv(self, name):
+        """Retrieve the SRV records for `name` from the nameserver.
+
+        :param str name: domain name to look up
+        :returns: possibly empty :class:`list` of
+            :class:`klempner.dns.SRVRecord` instances
+
+        The resolver for the nameserver is kept in the shared state so
+        that its answers are discarded when the library is reconfigured.
+        Cache misses go through :meth:`klempner.url.State.load_once` so
+        concurrent lookups of the same name share a single query.  If
+        the nameserver fails, then the previous answer is used even if
+        it has expired.
+
+        """
+        key = (self.parameters['nameserver'], self.parameters['min_ttl'])
+        try:
+            resolver = self.state.resolvers[key]
+        except KeyError:
+            resolver = self.state.resolvers.setdefault(
+                key,
+                dns.Resolver(key[0], min_ttl=self.parameters['min_ttl']))
+        return self.state.load_once(resolver.answers, name,
+                                    lambda: resolver.refresh_srv(name))
+
+    def resolve(self, service):
+        records = self.snapshot(service)
+        if not records:
+            raise errors.ServiceNotFoundError(service)
+        record = dns.select_srv(records)
+        return (config.URL_SCHEME_MAP.get(record.port, 'http'), record.target,
+                str(record.port))
+
+
+@register
+class ConsulDNSBackend(_ConsulFailoverMixin, _SRVBackend):
+    """Look up service details using consul's DNS interface."""
+
+    name = config.DiscoveryMethod.CONSUL_DNS
+    required_parameters = ('datacenter', )
+    optional_parameters = {
+        'failover_datacenters': (),
+        'nameserver': None,
+        'min_ttl': dns.DEFAULT_MIN_TTL,
+    }
+    default_port = 8600
+
+    @classmethod
+    def parameters_from_environment(cls):
+        return {
+            'datacenter': _require_envvar(cls.name, 'CONSUL_DATACENTER'),
+            'nameserver': os.environ.get('CONSUL_DNS_ADDR'),
+            'failover_datacenters': os.environ.get(
+                'CONSUL_FAILOVER_DATACENTERS'),
+            'min_ttl': os.environ.get('KLEMPNER_DNS_MIN_TTL',
+                                      dns.DEFAULT_MIN_TTL),
+        }
+
+    def srv_names(self, service):
+        yield '_{0}._tcp.service.{1}.consul'.format(
+            service, self.parameters['datacenter'])
+        for datacenter in self.failover_datacenters():
+            yield '_{0}._tcp.service.{1}.consul'.format(service, datacenter)
+
+
+@register
+class EnvironmentBackend(Backend):
+    """Read service details from environment variables."""
+
+    name = config.DiscoveryMethod.ENV_VARS
+
+    def resolve(self, service):
+        env_service = service.upper()
+        scheme = os.environ.get('{0}_SCHEME'.format(env_service), None)
+        host = os.environ.get('{0}_HOST'.format(env_service), None)
+        port = os.environ.get('{0}_PORT'.format(env_service), None)
+
+        if port is not None and port.startswith('tcp://'):
+            # special case for docker's ip:port format
+            parts = compat.urlparse(port)
+            port = str(parts.port)
+            if host is None:
+                host = parts.hostname
+        if scheme is None:
+            if port is not None:
+                scheme = config.URL_SCHEME_MAP.get(int(port), 'http')
+            else:
+                scheme = 'http'
+        return scheme, host or service, port
+
+
+@register
+class FileBackend(Backend):
+    """Read service details from a JSON or INI file.
+
+    The file is parsed into an in-memory mapping when the backend is
+    created.  Lookups check whether the file was replaced or modified
+    at most once every `check_interval` seconds and, if so, parse it
+    again and swap in the new mapping.  A file that fails to parse is
+    logged and the previous mapping is kept.
+
+    """
+
+    name = config.DiscoveryMethod.FILE
+    required_parameters = ('path', )
+    optional_parameters = {'check_interval': 5.0, 'file_format': None}
+    file_formats = {
+        '.json': 'json',
+        '.ini': 'ini',
+        '.cfg': 'ini',
+        '.conf': 'ini',
+    }
+
+    def __init__(self, **parameters):
+        super(FileBackend, self).__init__(**parameters)
+        self.logger = logging.getLogger(__package__).getChild('discovery')
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self._signature = None
+        self._services = {}
+        try:
+            self._reload(time.time())
+        except (IOError, OSError, ValueError,
+                compat.ConfigParserError) as error:
+            self.logger.error('failed to load %s: %s', parameters['path'],
+                              error)
+            raise errors.ConfigurationError('path', parameters['path'])
+
+    @classmethod
+    def normalize_parameters(cls, parameters):
+        parameters = super(FileBackend, cls).normalize_parameters(parameters)
+        file_format = parameters['file_format']
+        if not file_format:
+            extension = os.path.splitext(parameters['path'])[1].lower()
+            file_format = cls.file_formats.get(extension, 'json')
+        if file_format not in ('ini', 'json'):
+            raise errors.ConfigurationError('file_format', file_format)
+        parameters['file_format'] = file_format
+        try:
+            parameters['check_interval'] = float(parameters['check_interval'])
+        except (TypeError, ValueError):
+            raise errors.ConfigurationError('check_interval',
+                                            parameters['check_interval'])
+        return parameters
+
+    @classmethod
+    def parameters_from_environment(cls):
+        return {
+            'path': _require_envvar(cls.name, 'KLEMPNER_SERVICE_FILE'),
+            'check_interval': os.environ.get(
+                'KLEMPNER_SERVICE_FILE_INTERVAL', 5.0),
+        }
+
+    def resolve(self, service):
+        try:
+            scheme, host, port = self.snapshot(service)[service]
+        except KeyError:
+            raise errors.ServiceNotFoundError(service)
+        if scheme is None:
+            scheme = ('http' if port is None else
+                      config.URL_SCHEME_MAP.get(int(port), 'http'))
+        return scheme, host, port
+
+    def snapshot(self, service):
+        now = time.time()
+        if now >= self._next_check:
+            self._check(now)
+        return self._services
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def _check(self, now):
+        if not self._lock.acquire(False):
+            return  # another thread is already checking
+        try:
+            if now >= self._next_check:
+                self._reload(now)
+        except (IOError, OSError, ValueError,
+                compat.ConfigParserError) as error:
+            self.logger.warning('failed to reload %s, keeping %d services: %s',
+                                self.parameters['path'], len(self._services),
+                                error)
+        finally:
+            self._lock.release()
+
+    def _reload(self, now):
+        self._next_check = now + self.parameters['check_interval']
+        path = self.parameters['path']
+        stat = os.stat(path)
+        signature = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if signature == self._signature:
+            return
+        if self.parameters['file_format'] == 'ini':
+            entries = self._read_ini(path)
+        else:
+            with open(path) as service_file:
+                entries = json.load(service_file)
+        services = {}
+        if not isinstance(entries, dict):
+            raise ValueError('expected a mapping of service names')
+        for service, entry in entries.items():
+            if not isinstance(entry, dict):
+                raise ValueError('expected a mapping for {0}'.format(service))
+            port = entry.get('port')
+            port = None if port in (None, '') else str(int(port))
+            services[service] = (entry.get('scheme') or None,
+                                 entry.get('host') or service, port)
+        self.logger.debug('loaded %d services from %s', len(services), path)
+        self._services = services
+        self._signature = signature
+
+    @staticmethod
+    def _read_ini(path):
+        parser = compat.RawConfigParser()
+        if not parser.read(path):
+            raise IOError('{0} cannot be read'.format(path))
+        return {
+            section: dict(parser.items(section))
+            for section in parser.sections()
+        }
+
+
+@register
+class KubernetesBackend(Backend):
+    """Build Kubernetes cluster DNS names."""
+
+    name = config.DiscoveryMethod.K8S
+    required_parameters = ('namespace', )
+
+    @classmethod
+    def parameters_from_environment(cls):
+        return {
+            'namespace': os.environ.get('KUBERNETES_NAMESPACE', 'default'),
+        }
+
+    def resolve(self, service):
+        return ('http', '{0}.{1}.svc.cluster.local'.format(
+            service, self.parameters['namespace']), None)
+
+
+@register
+class KubernetesSRVBackend(_SRVBackend):
+    """Look up service ports using Kubernetes SRV records."""
+
+    name = config.DiscoveryMethod.K8S_SRV
+    required_parameters = ('namespace', )
+    optional_parameters = {
+        'nameserver': None,
+        'port_name': 'http',
+        'min_ttl': dns.DEFAULT_MIN_TTL,
+    }
+
+    @classmethod
+    def parameters_from_environment(cls):
+        return {
+            'namespace': os.environ.get('KUBERNETES_NAMESPACE', 'default'),
+            'nameserver': os.environ.get('KUBERNETES_DNS_ADDR'),
+            'port_name': os.environ.get('KUBERNETES_PORT_NAME', 'http'),
+            'min_ttl': os.environ.get('KLEMPNER_DNS_MIN_TTL',
+                                      dns.DEFAULT_MIN_TTL),
+        }
+
+    @classmethod
+    def default_nameserver(cls):
+        return (dns.system_nameserver()
+                or super(KubernetesSRVBackend, cls).default_nameserver())
+
+    def srv_names(self, service):
+        return [
+            '_{0}._tcp.{1}.{2}.svc.cluster.local'.format(
+                self.parameters['port_name'], service,
+                self.parameters['namespace'])
+        ]
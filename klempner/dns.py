@@ -0,0 +1,489 @@
+"""Minimal DNS client for SRV-based discovery.
+
+This module implements just enough of :rfc:`1035` to send SRV queries
+over UDP (with a TCP fallback for truncated responses) and parse the
+answers.  It exists so that the SRV-based discovery methods do not
+require a third-party DNS library.  It also contains the optional
+host name to IP address cache.
+
+"""
+from __future__ import unicode_literals
+
+import collections
+import itertools
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+
+from klempner import errors
+
+TYPE_SRV = 33
+CLASS_IN = 1
+
+DEFAULT_MIN_TTL = 5.0
+"""Default minimum number of seconds that SRV answers are cached for."""
+
+_FLAG_RECURSION_DESIRED = 0x0100
+_FLAG_TRUNCATED = 0x0200
+_FLAG_RESPONSE = 0x8000
+_RCODE_MASK = 0x000F
+_RCODE_NXDOMAIN = 3
+
+_HEADER = struct.Struct('!HHHHHH')
+_QUESTION_TAIL = struct.Struct('!HH')
+_RR_TAIL = struct.Struct('!HHIH')
+_SRV_FIXED = struct.Struct('!HHH')
+
+SRVRecord = collections.namedtuple(
+    'SRVRecord', ['priority', 'weight', 'port', 'target', 'ttl'])
+"""A parsed SRV resource record.
+
+The `target` is returned without the trailing dot.
+
+"""
+
+
+def parse_address(value, default_port):
+    """Parse a ``host[:port]`` string into a tuple.
+
+    :param str value: address to parse.  IPv6 addresses that include
+        a port MUST be enclosed in brackets.
+    :param int default_port: port to use if `value` does not include one
+    :rtype: tuple(str, int)
+
+    """
+    if value.startswith('['):
+        host, _, rest = value[1:].partition(']')
+        port = rest[1:] if rest.startswith(':') else None
+    elif value.count(':') == 1:
+        host, port = value.split(':')
+    else:
+        host, port = value, None
+    return host, int(port) if port else default_port
+
+
+def system_nameserver(path='/etc/resolv.conf'):
+    """Retrieve the first nameserver from the system configuration.
+
+    :param str path: resolver configuration to read
+    :returns: a ``(host, port)`` tuple or :data:`None` if the file
+        does not exist or does not contain a nameserver
+    :rtype: tuple(str, int)
+
+    """
+    try:
+        with open(path) as resolv_conf:
+            for line in resolv_conf:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    return fields[1], 53
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def encode_name(name):
+    """Encode a domain name as a sequence of labels.
+
+    :param str name: domain name to encode
+    :rtype: bytes
+
+    """
+    encoded = bytearray()
+    for label in name.rstrip('.').split('.'):
+        label = label.encode('ascii')
+        if not 0 < len(label) < 64:
+            raise ValueError('invalid DNS label in {0!r}'.format(name))
+        encoded.append(len(label))
+        encoded.extend(label)
+    encoded.append(0)
+    return bytes(encoded)
+
+
+def build_query(query_id, name, rtype):
+    """Build a single question query message.
+
+    :param int query_id: message identifier
+    :param str name: domain name to query
+    :param int rtype: resource record type to query for
+    :rtype: bytes
+
+    """
+    return b''.join([
+        _HEADER.pack(query_id, _FLAG_RECURSION_DESIRED, 1, 0, 0, 0),
+        encode_name(name),
+        _QUESTION_TAIL.pack(rtype, CLASS_IN),
+    ])
+
+
+def decode_name(message, offset):
+    """Decode a possibly compressed domain name.
+
+    :param bytearray message: the entire DNS message
+    :param int offset: where the name starts in `message`
+    :returns: a ``(name, next_offset)`` tuple where `next_offset` is
+        the offset immediately following the name in `message`
+    :rtype: tuple(str, int)
+
+    """
+    labels = []
+    next_offset = None
+    jumps = 0
+    while True:
+        length = message[offset]
+        if length & 0xC0 == 0xC0:
+            if next_offset is None:
+                next_offset = offset + 2
+            jumps += 1
+            if jumps > 64:
+                raise ValueError('DNS name compression loop detected')
+            offset = ((length & 0x3F) << 8) | message[offset + 1]
+        elif length:
+            offset += 1
+            labels.append(message[offset:offset + length].decode('ascii'))
+            offset += length
+        else:
+            offset += 1
+            break
+    return '.'.join(labels), offset if next_offset is None else next_offset
+
+
+def parse_response(data, query_id):
+    """Parse the SRV answers out of a response message.
+
+    :param bytes data: the response message
+    :param int query_id: identifier of the query that was sent
+    :returns: a ``(truncated, records)`` tuple
+    :rtype: tuple(bool, list)
+    :raises: :exc:`klempner.errors.DNSError` if the server returned an
+        error other than *name does not exist*
+
+    """
+    message = bytearray(data)
+    response_id, flags, qdcount, ancount, _, _ = _HEADER.unpack_from(data)
+    if response_id != query_id or not flags & _FLAG_RESPONSE:
+        raise ValueError('unexpected DNS message')
+    if flags & _FLAG_TRUNCATED:
+        return True, []
+
+    rcode = flags & _RCODE_MASK
+    if rcode == _RCODE_NXDOMAIN:
+        return False, []
+    if rcode:
+        raise errors.DNSError(rcode)
+
+    offset = _HEADER.size
+    for _ in range(qdcount):
+        _, offset = decode_name(message, offset)
+        offset += _QUESTION_TAIL.size
+
+    records = []
+    for _ in range(ancount):
+        _, offset = decode_name(message, offset)
+        rtype, rclass, ttl, rdlength = _RR_TAIL.unpack_from(data, offset)
+        offset += _RR_TAIL.size
+        if rtype == TYPE_SRV and rclass == CLASS_IN:
+            priority, weight, port = _SRV_FIXED.unpack_from(data, offset)
+            target, _ = decode_name(message, offset + _SRV_FIXED.size)
+            records.append(SRVRecord(priority, weight, port, target, ttl))
+        offset += rdlength
+    return False, records
+
+
+def select_srv(records):
+    """Select a record using the :rfc:`2782` selection algorithm.
+
+    :param list records: :class:`.SRVRecord` instances to select from
+    :returns: a record from the lowest priority group chosen randomly
+        in proportion to its weight
+    :rtype: SRVRecord
+
+    """
+    priority = min(record.priority for record in records)
+    candidates = [record for record in records if record.priority == priority]
+    total = sum(record.weight for record in candidates)
+    if not total:
+        return random.choice(candidates)
+    selected = random.randint(1, total)
+    for record in candidates:
+        selected -= record.weight
+        if selected <= 0:
+            return record
+    return candidates[-1]  # pragma: no cover
+
+
+class AnswerCache(object):
+    """Cache of DNS answers that remembers expired answers.
+
+    :param float negative_ttl: number of seconds to cache empty
+        answers for
+    :param float min_ttl: minimum number of seconds to cache
+        non-empty answers for
+
+    :meth:`get` only returns answers that have not expired so this can
+    be used as the cache for :meth:`klempner.url.State.load_once`.
+    Expired answers are kept so that they can be used when the
+    nameserver cannot be reached (see :meth:`stale`).
+
+    """
+
+    def __init__(self, negative_ttl=30.0, min_ttl=0.0):
+        self.negative_ttl = negative_ttl
+        self.min_ttl = min_ttl
+        self._entries = {}
+
+    def get(self, name, default=None):
+        """Retrieve the unexpired answer for `name`."""
+        try:
+            expires_at, records = self._entries[name]
+        except KeyError:
+            return default
+        return records if expires_at > time.time() else default
+
+    def stale(self, name):
+        """Retrieve the answer for `name` even if it has expired.
+
+        :returns: the most recent answer or :data:`None` if `name`
+            was never answered
+
+        """
+        entry = self._entries.get(name)
+        return None if entry is None else entry[1]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __setitem__(self, name, records):
+        if records:
+            ttl = max(self.min_ttl, min(r.ttl for r in records))
+        else:
+            ttl = self.negative_ttl
+        self._entries[name] = (time.time() + ttl, records)
+
+
+class Resolver(object):
+    """Send SRV queries to a nameserver and cache the answers.
+
+    :param tuple nameserver: ``(host, port)`` of the nameserver
+    :param float timeout: number of seconds to wait for a response
+    :param float negative_ttl: number of seconds to cache empty
+        answers for
+    :param float min_ttl: minimum number of seconds to cache answers
+        for regardless of their TTL
+
+    Answers are cached until the smallest TTL in the answer expires
+    but for at least `min_ttl` seconds.  Consul answers with a TTL of
+    zero by default so without the floor every lookup would be a round
+    trip to the nameserver.  Empty answers are cached for
+    `negative_ttl` seconds so that failing over to another name does
+    not cost a round trip to the nameserver for every lookup.
+
+    """
+
+    def __init__(self, nameserver, timeout=2.0, negative_ttl=30.0,
+                 min_ttl=0.0):
+        self.nameserver = nameserver
+        self.timeout = timeout
+        self.logger = logging.getLogger(__package__).getChild('dns')
+        self.answers = AnswerCache(negative_ttl, min_ttl)
+
+    def clear(self):
+        self.answers.clear()
+
+    def query_srv(self, name):
+        """Retrieve the SRV records for `name`.
+
+        :param str name: fully-qualified domain name to look up
+        :returns: possibly empty :class:`list` of :class:`.SRVRecord`
+            instances
+
+        """
+        records = self.answers.get(name)
+        if records is None:
+            records = self.refresh_srv(name)
+            self.answers[name] = records
+        return records
+
+    def refresh_srv(self, name):
+        """Query the nameserver for `name` without consulting the cache.
+
+        :param str name: fully-qualified domain name to look up
+        :returns: possibly empty :class:`list` of :class:`.SRVRecord`
+            instances
+        :raises: :exc:`klempner.errors.DNSError`, :exc:`ValueError`, or
+            :exc:`socket.error` if the query fails and there is no
+            previous answer for `name`
+
+        If the query fails, then the previous answer is returned even
+        if it has expired.  The caller is responsible for storing the
+        result in :attr:`answers`.
+
+        """
+        try:
+            return self._query(name, TYPE_SRV)
+        except (errors.DNSError, ValueError, socket.error) as error:
+            records = self.answers.stale(name)
+            if records is None:
+                raise
+            self.logger.warning('failed to query %s for %s, using the '
+                                'previous answer: %s', self.nameserver[0],
+                                name, error)
+            return records
+
+    def _query(self, name, rtype):
+        query_id = random.randint(0, 0xFFFF)
+        query = build_query(query_id, name, rtype)
+        self.logger.debug('querying %s:%s for %s', self.nameserver[0],
+                          self.nameserver[1], name)
+        truncated, records = parse_response(self._send_udp(query, query_id),
+                                            query_id)
+        if truncated:
+            self.logger.debug('response for %s truncated, retrying over TCP',
+                              name)
+            truncated, records = parse_response(self._send_tcp(query),
+                                                query_id)
+        return records
+
+    def _connect(self, socket_type):
+        family, _, _, _, address = socket.getaddrinfo(self.nameserver[0],
+                                                      self.nameserver[1], 0,
+                                                      socket_type)[0]
+        sock = socket.socket(family, socket_type)
+        sock.settimeout(self.timeout)
+        return sock, address
+
+    def _send_udp(self, query, query_id):
+        sock, address = self._connect(socket.SOCK_DGRAM)
+        try:
+            sock.sendto(query, address)
+            while True:
+                data, _ = sock.recvfrom(65535)
+                if (len(data) >= _HEADER.size
+                        and struct.unpack('!H', data[:2])[0] == query_id):
+                    return data
+        finally:
+            sock.close()
+
+    def _send_tcp(self, query):
+        sock, address = self._connect(socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+            sock.sendall(struct.pack('!H', len(query)) + query)
+            length = struct.unpack('!H', self._recv_exactly(sock, 2))[0]
+            return self._recv_exactly(sock, length)
+        finally:
+            sock.close()
+
+    @staticmethod
+    def _recv_exactly(sock, length):
+        chunks = []
+        while length:
+            chunk = sock.recv(length)
+            if not chunk:
+                raise ValueError('DNS connection closed prematurely')
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b''.join(chunks)
+
+
+class _AddressEntry(object):
+    __slots__ = ('addresses', 'counter', 'expires_at')
+
+    def __init__(self, addresses, expires_at):
+        self.addresses = addresses
+        self.counter = itertools.count()
+        self.expires_at = expires_at
+
+
+class AddressCache(object):
+    """Cache of host name to IP address resolutions.
+
+    :param float ttl: number of seconds that a resolution is used
+        before it is refreshed
+
+    Host names are resolved using :func:`socket.getaddrinfo` the first
+    time that they are requested.  Once the `ttl` expires, the cached
+    addresses continue to be used while a background thread resolves
+    the name again so that callers never wait on DNS for a host that
+    has been seen before.  :func:`socket.getaddrinfo` does not expose
+    record TTLs so the same `ttl` is applied to every host.
+
+    """
+
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        self.logger = logging.getLogger(__package__).getChild('dns')
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def clear(self):
+        self._entries.clear()
+
+    def after_fork(self):
+        """Replace the lock and forget refreshes owned by the parent."""
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    def addresses(self, host, port=None):
+        """Retrieve the IP addresses for `host`.
+
+        :param str host: host name to resolve
+        :param int port: optional port used to filter out addresses
+            that cannot be connected to
+        :rtype: list
+
+        """
+        return self._lookup(host, port).addresses
+
+    def next_address(self, host, port=None):
+        """Retrieve the next IP address for `host` in round-robin order.
+
+        :param str host: host name to resolve
+        :param int port: optional port used to filter out addresses
+            that cannot be connected to
+        :rtype: str
+
+        """
+        entry = self._lookup(host, port)
+        return entry.addresses[next(entry.counter) % len(entry.addresses)]
+
+    def _lookup(self, host, port):
+        key = (host, port)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._resolve(key)
+        elif entry.expires_at <= time.time():
+            with self._lock:
+                start_refresh = key not in self._refreshing
+                self._refreshing.add(key)
+            if start_refresh:
+                thread = threading.Thread(target=self._refresh, args=(key, ))
+                thread.daemon = True
+                thread.start()
+        return entry
+
+    def _refresh(self, key):
+        try:
+            self._resolve(key)
+        except socket.error as error:
+            self.logger.warning('failed to refresh addresses for %s: %s',
+                                key[0], error)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _resolve(self, key):
+        host, port = key
+        addresses = []
+        for info in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+            address = info[4][0]
+            if address not in addresses:
+                addresses.append(address)
+        self.logger.debug('resolved %s to %r', host, addresses)
+        entry = _AddressEntry(addresses, time.time() + self.ttl)
+        self._entries[key] = entry
+        return entry
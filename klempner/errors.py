@@ -12,6 +12,14 @@ class ServiceNotFoundError(KlempnerError):
                                                    **kwargs)
 
 
+class DiscoveryError(KlempnerError):
+    """Discovery mechanism failed to answer for a service."""
+
+    def __init__(self, service_name, *args):
+        self.service_name = service_name
+        super(DiscoveryError, self).__init__(service_name, *args)
+
+
 class ConfigurationError(KlempnerError):
     """Configuration is invalid."""
 
@@ -20,3 +28,11 @@ class ConfigurationError(KlempnerError):
         self.configuration_value = config_value
         super(ConfigurationError, self).__init__(config_option, config_value,
                                                  *args)
+
+
+class DNSError(KlempnerError):
+    """DNS server responded with an error."""
+
+    def __init__(self, rcode, *args):
+        self.rcode = rcode
+        super(DNSError, self).__init__(rcode, *args)
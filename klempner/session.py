@@ -0,0 +1,208 @@
+"""Per-service HTTP sessions built on discovery."""
+from __future__ import unicode_literals
+
+import collections
+import logging
+import threading
+import time
+
+import requests.adapters
+
+from klempner import compat, config, url
+
+DEFAULT_POOL_MAXSIZE = 10
+"""Default number of connections kept alive for each service."""
+
+MAX_INSTANCE_POOLS = 32
+"""Maximum number of service instances that a session keeps pools for."""
+
+POOL_IDLE_TIMEOUT = 300.0
+"""Seconds after which the pool for an unused instance is retired."""
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class ServiceSession(requests.Session):
+    """A :class:`requests.Session` that is bound to a single service.
+
+    :param str service: name of the service to target
+    :param int pool_maxsize: number of connections to keep alive
+    :param bool pool_block: block when no free connections are
+        available instead of creating a throw-away connection
+
+    Relative URLs passed to the request methods are resolved against
+    :attr:`.base_url` which is calculated by discovering `service`.
+    Absolute URLs are passed through untouched.  Discovery happens
+    before each request and a connection pool is kept for each instance
+    that discovery returns.  This means that kept-alive connections
+    survive discovery cache refreshes and discovery methods that spread
+    requests over several instances.  Pools for instances that have not
+    been used for :data:`POOL_IDLE_TIMEOUT` seconds are retired when a
+    new instance is discovered.  Retired pools are not closed so that
+    requests that are in flight on other threads can finish.
+
+    .. code-block:: python
+
+       session = klempner.session_for('account')
+       response = session.get('accounts/1234')
+
+    """
+
+    def __init__(self, service, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 pool_block=False):
+        super(ServiceSession, self).__init__()
+        self.service = service
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.base_url = None
+        self.logger = logging.getLogger(__package__).getChild('session')
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Discover the service and create a pool if it is a new instance.
+
+        :returns: the current base URL for the service
+        :rtype: str
+
+        """
+        config.ensure_configured()
+        network_portion = url._discover(self.service)
+        pool = self._pools.get(network_portion)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(network_portion)
+                if pool is None:
+                    pool = self._add_pool(network_portion)
+        pool.last_used = time.time()
+        self.base_url = pool.base_url
+        return pool.base_url
+
+    def resize_pool(self, pool_maxsize, pool_block=None):
+        """Change the pool sizing and rebuild the pools.
+
+        :param int pool_maxsize: number of connections to keep alive
+        :param bool pool_block: optionally change the blocking mode
+
+        """
+        with self._lock:
+            self.pool_maxsize = pool_maxsize
+            if pool_block is not None:
+                self.pool_block = pool_block
+            self._install_pools(dict(
+                (network_portion,
+                 _InstancePool(pool.base_url, self._create_adapter(),
+                               pool.last_used))
+                for network_portion, pool in self._pools.items()))
+
+    def after_fork(self):
+        """Drop the connection pools inherited from the parent process.
+
+        The inherited adapters are discarded without closing them so
+        that the parent's connections are not disturbed.  The pool is
+        rebuilt by the next request.
+
+        """
+        self._lock = threading.Lock()
+        self._pools = {}
+        self.adapters = collections.OrderedDict()
+        self.mount('https://', requests.adapters.HTTPAdapter())
+        self.mount('http://', requests.adapters.HTTPAdapter())
+        self.base_url = None
+
+    def request(self, method, url, *args, **kwargs):
+        base_url = self.refresh()
+        if not compat.urlparse(url).scheme:
+            url = base_url + url.lstrip('/')
+        return super(ServiceSession, self).request(method, url, *args,
+                                                   **kwargs)
+
+    def _add_pool(self, network_portion):
+        base_url = url._format_network_portion(network_portion) + '/'
+        self.logger.debug('adding pool for service %s at %s', self.service,
+                          base_url)
+        now = time.time()
+        pools = dict((key, pool) for key, pool in self._pools.items()
+                     if now - pool.last_used < POOL_IDLE_TIMEOUT)
+        while len(pools) >= MAX_INSTANCE_POOLS:
+            del pools[min(pools, key=lambda key: pools[key].last_used)]
+        pool = _InstancePool(base_url, self._create_adapter(), now)
+        pools[network_portion] = pool
+        self._install_pools(pools)
+        return pool
+
+    def _create_adapter(self):
+        return requests.adapters.HTTPAdapter(pool_connections=1,
+                                             pool_maxsize=self.pool_maxsize,
+                                             pool_block=self.pool_block)
+
+    def _install_pools(self, pools):
+        # Requests iterates over the adapters without locking, so a new
+        # mapping is built and swapped in instead of mutating it in place.
+        # Adapters that are dropped are left for the garbage collector.
+        retired = set(pool.base_url for pool in self._pools.values())
+        adapters = [(pool.base_url, pool.adapter) for pool in pools.values()]
+        adapters.extend((prefix, adapter)
+                        for prefix, adapter in self.adapters.items()
+                        if prefix not in retired)
+        adapters.sort(key=lambda item: len(item[0]), reverse=True)
+        self.adapters = collections.OrderedDict(adapters)
+        self._pools = pools
+
+
+class _InstancePool(object):
+    __slots__ = ('base_url', 'adapter', 'last_used')
+
+    def __init__(self, base_url, adapter, last_used):
+        self.base_url = base_url
+        self.adapter = adapter
+        self.last_used = last_used
+
+
+def session_for(service, pool_maxsize=None, pool_block=None):
+    """Retrieve the shared session for `service`.
+
+    :param str service: name of the service to target
+    :param int pool_maxsize: optional number of connections to keep
+        alive for the service
+    :param bool pool_block: optionally block when the pool is exhausted
+    :rtype: ServiceSession
+
+    The same session is returned for each call with the same `service`.
+    If the pool sizing parameters are specified and differ from the
+    session's current settings, then the pool is resized.
+
+    """
+    try:
+        session = _sessions[service]
+    except KeyError:
+        with _sessions_lock:
+            session = _sessions.get(service)
+            if session is None:
+                session = ServiceSession(
+                    service, pool_maxsize=pool_maxsize or DEFAULT_POOL_MAXSIZE,
+                    pool_block=bool(pool_block))
+                _sessions[service] = session
+                return session
+
+    if ((pool_maxsize is not None and pool_maxsize != session.pool_maxsize)
+            or (pool_block is not None and pool_block != session.pool_block)):
+        session.resize_pool(pool_maxsize or session.pool_maxsize, pool_block)
+    return session
+
+
+@url._at_fork
+def _after_fork():
+    global _sessions_lock
+    _sessions_lock = threading.Lock()
+    for session in _sessions.values():
+        session.after_fork()
+
+
+def reset():
+    """Close and forget all of the per-service sessions."""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
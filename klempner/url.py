@@ -2,11 +2,13 @@ from __future__ import unicode_literals
 
 import logging
 import os
+import re
+import threading
 
 import requests.adapters
 
 import cachetools
-from klempner import compat, config, errors, version
+from klempner import compat, config, dns, version
 
 #    pchar         = unreserved / pct-encoded / sub-delims / ":" / "@"
 #    sub-delims    = "!" / "$" / "&" / "'" / "(" / ")"
@@ -16,6 +18,206 @@ from klempner import compat, config, errors, version
 PATH_SAFE_CHARS = ":@!$&'()*+,;=-._~"
 """Safe characters for path elements."""
 
+URL_BUFFER_SIZE = 1024
+"""Initial size of the per-thread buffer used by :func:`.build_url_bytes`."""
+
+_AUTHORITY_PATTERN = re.compile(r'[A-Za-z][A-Za-z0-9+.-]*://([^/?#]*)')
+
+
+class _Quoter(object):
+    """Percent-encode values using a precomputed lookup table.
+
+    :param str safe: characters that should not be quoted
+    :param int memo_size: number of encoded values to remember or
+        zero to disable memoization
+
+    Instances are callable and produce exactly what
+    :func:`urllib.parse.quote` produces for the UTF-8 encoded value.
+    The lookup table is built by calling :func:`~urllib.parse.quote`
+    for each octet so the output cannot diverge from the standard
+    library.  Values that consist entirely of safe ASCII characters
+    are returned as-is.  Memoization is meant for low-cardinality
+    values such as path segments and parameter names -- the memo is
+    simply cleared once it reaches `memo_size` entries.
+
+    :meth:`encode` produces the same value as ASCII :class:`bytes`
+    directly from a parallel table of encoded octets.
+
+    """
+
+    __slots__ = ('byte_memo', 'byte_table', 'memo', 'memo_size',
+                 'safe_match', 'table')
+
+    def __init__(self, safe, memo_size=0):
+        self.table = tuple(
+            compat.quote(bytes(bytearray([octet])), safe=safe)
+            for octet in range(256))
+        self.byte_table = tuple(
+            quoted.encode('ascii') for quoted in self.table)
+        safe_chars = ''.join(
+            chr(octet)
+            for octet in range(128)
+            if self.table[octet] == chr(octet))
+        self.safe_match = re.compile('[{0}]*\\Z'.format(
+            re.escape(safe_chars))).match
+        self.memo = {}
+        self.byte_memo = {}
+        self.memo_size = memo_size
+
+    def __call__(self, value):
+        if not isinstance(value, compat.TEXT_TYPES):
+            value = str(value)
+        if self.memo_size:
+            try:
+                return self.memo[value]
+            except KeyError:
+                pass
+
+        if self.safe_match(value):
+            quoted = value
+        else:
+            table = self.table
+            quoted = ''.join(
+                [table[octet] for octet in bytearray(value.encode('utf-8'))])
+
+        if self.memo_size:
+            if len(self.memo) >= self.memo_size:
+                self.memo.clear()
+            self.memo[value] = quoted
+        return quoted
+
+    def encode(self, value):
+        """Quote `value` into ASCII :class:`bytes`."""
+        if not isinstance(value, compat.TEXT_TYPES):
+            value = str(value)
+        if self.memo_size:
+            try:
+                return self.byte_memo[value]
+            except KeyError:
+                pass
+
+        encoded = value.encode('utf-8')
+        if not self.safe_match(value):
+            table = self.byte_table
+            encoded = b''.join([table[octet] for octet in bytearray(encoded)])
+
+        if self.memo_size:
+            if len(self.byte_memo) >= self.memo_size:
+                self.byte_memo.clear()
+            self.byte_memo[value] = encoded
+        return encoded
+
+
+_quote_path_element = _Quoter(PATH_SAFE_CHARS, memo_size=1024)
+_quote_query_name = _Quoter('/', memo_size=256)
+_quote_query_value = _Quoter('/')
+
+
+class QueryOrdering(object):
+    """Orderings understood by :class:`.QueryEncoder`."""
+
+    SORTED = 'sorted'
+    """Sort the names and the values of each name.  This is the default."""
+
+    STABLE = 'stable'
+    """Sort the names but keep the values of each name in order."""
+
+    INSERTION = 'insertion'
+    """Keep the parameters in the order that they were given in."""
+
+    AVAILABLE = (SORTED, STABLE, INSERTION)
+
+
+class QueryEncoder(object):
+    """Encode query parameters into a query string.
+
+    :param str ordering: one of the :class:`.QueryOrdering` values
+    :param bool flatten: flatten nested mappings into bracketed names
+        instead of raising :exc:`ValueError`
+
+    Parameters are given as a mapping or as an iterable of ``(name,
+    value)`` pairs.  Values that are non-string iterables are expanded
+    into one parameter for each element.  When `flatten` is enabled,
+    ``{'a': {'b': 'c'}}`` is encoded as the parameter named ``a[b]``
+    (the brackets are percent-encoded like any other reserved
+    character).
+
+    With :attr:`.QueryOrdering.INSERTION`, the parameters are encoded
+    as they are consumed so arbitrarily large iterables are not sorted
+    or copied.  Each name is quoted once for all of its values and
+    lists of integers are joined without passing each element through
+    the quoting table.
+
+    """
+
+    __slots__ = ('flatten', 'ordering')
+
+    def __init__(self, ordering=QueryOrdering.SORTED, flatten=False):
+        if ordering not in QueryOrdering.AVAILABLE:
+            raise ValueError('unknown query ordering {0!r}'.format(ordering))
+        self.ordering = ordering
+        self.flatten = flatten
+
+    def encode(self, query):
+        """Encode `query` into a query string without a leading ``?``.
+
+        :param query: mapping or iterable of ``(name, value)`` pairs
+        :rtype: str
+        :raises: :exc:`ValueError` if a value is a mapping and
+            :attr:`flatten` is disabled
+
+        """
+        chunks = []
+        for name, values in self.groups(query):
+            if not values:
+                continue
+            prefix = _quote_query_name(name) + '='
+            if all(type(value) is int for value in values):
+                encoded = map(str, values)
+            else:
+                encoded = map(_quote_query_value, values)
+            chunks.append(prefix + ('&' + prefix).join(encoded))
+        return '&'.join(chunks)
+
+    def groups(self, query):
+        """Flatten `query` into ``(name, values)`` groups in output order.
+
+        :param query: mapping or iterable of ``(name, value)`` pairs
+        :returns: an iterable of ``(name, values)`` tuples where `values`
+            is a sequence
+
+        """
+        if isinstance(query, compat.Mapping):
+            query = query.items()
+        groups = (group for name, value in query
+                  for group in self._expand(name, value))
+        if self.ordering == QueryOrdering.INSERTION:
+            return groups
+        if self.ordering == QueryOrdering.STABLE:
+            return sorted(groups, key=lambda group: group[0])
+
+        merged = {}
+        for name, values in groups:
+            merged.setdefault(name, []).extend(values)
+        return [(name, _sort_values(merged[name])) for name in sorted(merged)]
+
+    def _expand(self, name, value):
+        if isinstance(value, compat.Mapping):
+            if not self.flatten:
+                raise ValueError('Mapping query parameters are unsupported')
+            for key, nested in value.items():
+                for group in self._expand('{0}[{1}]'.format(name, key),
+                                          nested):
+                    yield group
+        elif (isinstance(value, compat.Iterable)
+              and not isinstance(value, compat.TEXT_TYPES)):
+            yield name, list(value)
+        else:
+            yield name, (value, )
+
+
+_query_encoder = QueryEncoder()
+
 
 class State(object):
     """Module state.
@@ -28,38 +230,111 @@ class State(object):
     """
 
     def __init__(self):
+        self.pid = os.getpid()
         self.discovery_cache = cachetools.TTLCache(50, 300)
+        self.coordinate_cache = cachetools.TTLCache(4, 300)
         self.logger = logging.getLogger(__package__)
+        self.resolvers = {}
+        self.address_cache = None
         self.session = self._create_session()
+        self.service_index = {}
+        self.network_prefixes = {}
+        self.encoded_prefixes = {}
+        self._indexed = {}
+        self._loading = {}
+        self._loading_lock = threading.Lock()
 
     def clear(self):
         self.discovery_cache.clear()
+        self.coordinate_cache.clear()
+        self.resolvers.clear()
+        self.service_index.clear()
+        self.network_prefixes.clear()
+        self.encoded_prefixes.clear()
+        self._indexed.clear()
+        if self.address_cache is not None:
+            self.address_cache.clear()
         self.session.close()
         self.session = self._create_session()
 
-    def lookup_consul_service(self, service):
-        sentinel = object()
-        service_info = self.discovery_cache.get(service, sentinel)
-        if service_info is sentinel:
-            parsed = compat.urlparse(os.environ['CONSUL_AGENT_URL'])
-            url = compat.urlunparse(
-                (parsed[0], parsed[1],
-                 '/v1/catalog/service/{0}'.format(service), '', '', ''))
-            headers = {}
-            if os.environ.get('CONSUL_HTTP_TOKEN'):
-                headers['Authorization'] = 'Bearer {0}'.format(
-                    os.environ['CONSUL_HTTP_TOKEN'])
-
-            response = self.session.get(url, headers=headers)
-            response.raise_for_status()
-            body = response.json()
-            if body:
-                service_info = body[0]
-                self.discovery_cache[service] = service_info
-            else:
-                service_info = None
+    def after_fork(self):
+        """Replace process-specific resources in a forked child.
 
-        return service_info
+        The HTTP session and locks are replaced since they cannot be
+        shared with the parent process.  The discovery caches are kept
+        so that the child starts with everything that the parent had
+        already discovered.
+
+        """
+        self.pid = os.getpid()
+        self.session = self._create_session()
+        self._loading = {}
+        self._loading_lock = threading.Lock()
+        if self.address_cache is not None:
+            self.address_cache.after_fork()
+
+    def index_service(self, service, network_portion):
+        """Remember that `network_portion` belongs to `service`.
+
+        :param str service: name of the service that was discovered
+        :param tuple network_portion: the discovered ``(scheme, host,
+            port)`` tuple
+
+        The authority is only formatted the first time that a network
+        portion is seen so this is cheap enough to call on every
+        discovery.  See :func:`.identify`.
+
+        """
+        if self._indexed.get(network_portion) == service:
+            return
+        _, host, port = network_portion
+        self.index_authority(service, host, port)
+        self._indexed[network_portion] = service
+
+    def index_authority(self, service, host, port):
+        """Map the authority for `host` and `port` to `service`.
+
+        :param str service: name of the service
+        :param str host: host name or IP address
+        :param port: optional port number
+
+        """
+        authority = _format_authority(host, port)
+        self.service_index[authority] = service
+        self.service_index[authority.lower()] = service
+
+    def load_once(self, cache, key, loader):
+        """Retrieve `key` from `cache` calling `loader` on a miss.
+
+        :param cache: mapping to retrieve the value from
+        :param key: key to retrieve
+        :param loader: callable that returns the value to cache
+            or :data:`None` if the value should not be cached
+        :returns: the cached or newly loaded value
+
+        Concurrent misses for the same key are coalesced so that only
+        one thread calls `loader` while the others wait for its result.
+        Discovery backends SHOULD use this for any remote lookups.
+
+        """
+        sentinel = object()
+        value = cache.get(key, sentinel)
+        if value is not sentinel:
+            return value
+
+        with self._loading_lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                value = cache.get(key, sentinel)
+                if value is sentinel:
+                    value = loader()
+                    if value is not None:
+                        cache[key] = value
+        finally:
+            with self._loading_lock:
+                self._loading.pop(key, None)
+        return value
 
     @staticmethod
     def _create_session():
@@ -69,6 +344,85 @@ class State(object):
 
 
 _state = State()
+_thread_state = threading.local()
+_fork_handlers = []
+
+
+class ServiceURL(object):
+    """A service URL that is split into its components.
+
+    :param str scheme: URL scheme
+    :param str host: host portion of the authority
+    :param int port: port portion of the authority or :data:`None`
+    :param str path: quoted, absolute path
+    :param str query: quoted query string without the leading ``?``
+    :param str server_name: name of the server if `host` is an IP
+        address that the name was resolved to
+
+    Instances are created by :func:`.build_service_url`.  The string
+    form of the URL is rendered the first time that it is requested
+    and cached after that.  Connection pools can key directly on
+    :attr:`.pool_key` without re-parsing the URL.
+
+    If address resolution is enabled (see
+    :func:`.enable_address_resolution`), then :attr:`host` is an IP
+    address and :attr:`server_name` is the discovered host name which
+    should be used for the ``Host`` header and TLS server name
+    indication.  Otherwise, :attr:`server_name` is the same as
+    :attr:`host`.
+
+    """
+
+    __slots__ = ('scheme', 'host', 'port', 'path', 'query', 'server_name',
+                 '_url')
+
+    def __init__(self, scheme, host, port, path, query, server_name=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.path = path
+        self.query = query
+        self.server_name = server_name or host
+        self._url = None
+
+    @property
+    def netloc(self):
+        """The authority portion of the URL."""
+        return _format_authority(self.host, self.port)
+
+    @property
+    def pool_key(self):
+        """A ``(scheme, host, port)`` tuple for connection pooling."""
+        return self.scheme, self.host, self.port
+
+    def __str__(self):
+        if self._url is None:
+            buf = compat.StringIO()
+            buf.write(self.scheme)
+            buf.write('://')
+            buf.write(self.netloc)
+            buf.write(self.path)
+            if self.query:
+                buf.write('?')
+                buf.write(self.query)
+            self._url = buf.getvalue()
+        return self._url
+
+    def __repr__(self):
+        return '<{0}.{1} {2!r}>'.format(self.__class__.__module__,
+                                        self.__class__.__name__, str(self))
+
+    def __eq__(self, other):
+        if isinstance(other, ServiceURL):
+            return str(self) == str(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash(str(self))
 
 
 def build_url(service, *path, **query):
@@ -84,27 +438,210 @@ def build_url(service, *path, **query):
     config.ensure_configured()
     buf = compat.StringIO()
     _write_network_portion(buf, service)
-    buf.write('/')
-    buf.write('/'.join(
-        compat.quote(str(p), safe=PATH_SAFE_CHARS) for p in path))
+    _write_path_and_query(buf, path, query)
+    return buf.getvalue()
 
-    query_tuples = []
-    for name, value in query.items():
-        if isinstance(value, compat.Mapping):
-            raise ValueError('Mapping query parameters are unsupported')
-        if (isinstance(value, compat.Iterable)
-                and not isinstance(value, compat.TEXT_TYPES)):
-            query_tuples.extend((name, elm) for elm in sorted(value))
-        else:
-            query_tuples.append((name, value))
-    if query_tuples:
-        query_tuples.sort()
-        buf.write('?')
-        buf.write('&'.join(
-            '{0}={1}'.format(_quote_query_arg(name), _quote_query_arg(value))
-            for name, value in query_tuples))
 
-    return buf.getvalue()
+def build_url_bytes(service, *path, **query):
+    """Build a URL that targets `service` as ASCII :class:`bytes`.
+
+    :param str service: service to target
+    :param path: request path elements
+    :param query: request query parameters
+    :rtype: bytes
+
+    The result is ``build_url(...).encode('ascii')`` without creating
+    the intermediate string.  The URL is assembled in a buffer that is
+    allocated once per thread and reused for every call.
+
+    """
+    config.ensure_configured()
+    try:
+        writer = _thread_state.writer
+    except AttributeError:
+        writer = _ByteWriter(bytearray(URL_BUFFER_SIZE), growable=True)
+        _thread_state.writer = writer
+    writer.position = 0
+    _write_url_bytes(writer, service, path, query)
+    return memoryview(writer.buf)[:writer.position].tobytes()
+
+
+def build_url_into(buf, service, *path, **query):
+    """Write a URL that targets `service` into `buf`.
+
+    :param buf: a :class:`bytearray` or writable :class:`memoryview`
+        to write the ASCII encoded URL into starting at the first byte
+    :param str service: service to target
+    :param path: request path elements
+    :param query: request query parameters
+    :returns: the number of bytes written
+    :rtype: int
+    :raises: :exc:`ValueError` if `buf` is too small for the URL
+
+    This is the zero-copy form of :func:`.build_url_bytes` for clients
+    that manage their own request buffers.
+
+    """
+    config.ensure_configured()
+    writer = _ByteWriter(buf)
+    _write_url_bytes(writer, service, path, query)
+    return writer.position
+
+
+def build_service_url(service, *path, **query):
+    """Build a :class:`.ServiceURL` that targets `service`.
+
+    :param str service: service to target
+    :param path: request path elements
+    :param query: request query parameters
+    :rtype: ServiceURL
+
+    This accepts the same parameters as :func:`.build_url` but returns
+    the URL components instead of a string.  ``str(build_service_url(...))``
+    is identical to ``build_url(...)`` unless address resolution is
+    enabled.
+
+    """
+    config.ensure_configured()
+    scheme, host, port_str = _discover(service)
+    port = None if port_str is None else int(port_str)
+    server_name = host
+    if _state.address_cache is not None:
+        host = _state.address_cache.next_address(host, port)
+        _state.index_service(service, (scheme, host, port_str))
+    return ServiceURL(scheme, host, port, _encode_path(path),
+                      _encode_query(query), server_name=server_name)
+
+
+def identify(url):
+    """Identify the service that a URL was built for.
+
+    :param url: a URL string, :class:`.ServiceURL` instance, or ASCII
+        encoded URL such as the output of :func:`.build_url_bytes` or
+        :func:`.build_url_into`
+    :returns: the name of the service or :data:`None` if the authority
+        was never returned from discovery
+    :rtype: str
+
+    Every discovery records the discovered authority (``host:port``) in
+    an index so this is a single dictionary lookup after the authority
+    is extracted from `url`.  This makes it cheap enough to call from
+    metrics and tracing middleware for each outgoing request.
+
+    .. code-block:: python
+
+       url = klempner.url.build_url('account', 'users')
+       klempner.url.identify(url)  # 'account'
+
+    """
+    if isinstance(url, ServiceURL):
+        authority = url.netloc
+    else:
+        if isinstance(url, memoryview):
+            url = url.tobytes()
+        if (isinstance(url, (bytes, bytearray))
+                and not isinstance(url, compat.TEXT_TYPES)):
+            try:
+                url = url.decode('ascii')
+            except UnicodeDecodeError:
+                return None
+        match = _AUTHORITY_PATTERN.match(url)
+        if match is None:
+            return None
+        authority = match.group(1)
+        if '@' in authority:
+            authority = authority.rpartition('@')[2]
+    service = _state.service_index.get(authority)
+    if service is None:
+        service = _state.service_index.get(authority.lower())
+    return service
+
+
+def configure_query_encoding(ordering=QueryOrdering.SORTED, flatten=False):
+    """Change how the URL building functions encode query parameters.
+
+    :param str ordering: one of the :class:`.QueryOrdering` values
+    :param bool flatten: flatten nested mappings into bracketed names
+        instead of raising :exc:`ValueError`
+
+    Calling this without parameters restores the default encoding.
+    See :class:`.QueryEncoder` for details.
+
+    """
+    global _query_encoder
+    _query_encoder = QueryEncoder(ordering, flatten)
+
+
+def enable_address_resolution(ttl=30.0):
+    """Resolve discovered host names in :func:`.build_service_url`.
+
+    :param float ttl: number of seconds to use a resolution before
+        refreshing it
+
+    After this is called, the :class:`.ServiceURL` instances returned
+    from :func:`.build_service_url` contain an IP address as the host
+    and the discovered name as the :attr:`~.ServiceURL.server_name`.
+    Addresses are cached and handed out in round-robin order.  Expired
+    entries are refreshed in the background so DNS is kept out of the
+    request path for services that have been used before.
+
+    """
+    _state.address_cache = dns.AddressCache(ttl)
+
+
+def disable_address_resolution():
+    """Stop resolving host names in :func:`.build_service_url`."""
+    _state.address_cache = None
+
+
+def build_urls(service, paths):
+    """Generate URLs that target `service` from a stream of requests.
+
+    :param str service: service to target
+    :param paths: iterable of request paths or ``(path, query)``
+        pairs where `path` is a path element or a sequence of path
+        elements and `query` is a mapping of query parameters
+    :returns: a generator of fully-formed, absolute URLs
+    :rtype: collections.abc.Iterator
+
+    This is equivalent to calling :func:`.build_url` for each request
+    except that the network portion of the URL is discovered once per
+    batch instead of once per URL.  When the ``consul+agent`` method is
+    in use, the network portion is re-calculated whenever the cached
+    service details are refreshed (see
+    :meth:`klempner.discovery.Backend.snapshot`).  Discovery methods
+    that spread requests over several instances, such as the SRV-based
+    methods, select an instance for each URL (see
+    :attr:`klempner.discovery.Backend.rotating`).  URLs are generated
+    lazily so `paths` can be an arbitrarily large stream.
+
+    .. code-block:: python
+
+       for url in build_urls('account', (('accounts', account_id)
+                                         for account_id in account_ids)):
+           process(url)
+
+    """
+    config.ensure_configured()
+    backend = config.get_service_backend(service)
+
+    buf = compat.StringIO()
+    snapshot = None
+    prefix = None
+    for request in paths:
+        current = backend.snapshot(service)
+        if current is not snapshot:
+            snapshot = current
+            prefix = None
+        if prefix is None or backend.rotating:
+            prefix = _network_prefix(_discover(service))
+
+        path, query = _split_request(request)
+        buf.seek(0)
+        buf.truncate(0)
+        buf.write(prefix)
+        _write_path_and_query(buf, path, query)
+        yield buf.getvalue()
 
 
 def _reset_cache():
@@ -120,6 +657,118 @@ def _reset_cache():
     _state.clear()
 
 
+def _split_request(request):
+    """Split a :func:`.build_urls` request into path and query.
+
+    :returns: a ``(path, query)`` tuple where `path` is a sequence of
+        path elements and `query` is a mapping of query parameters
+    :rtype: tuple
+
+    """
+    if (isinstance(request, (list, tuple)) and len(request) == 2
+            and isinstance(request[1], compat.Mapping)):
+        path, query = request
+    else:
+        path, query = request, {}
+    if (isinstance(path, compat.TEXT_TYPES)
+            or not isinstance(path, compat.Iterable)):
+        path = (path, )
+    return path, query
+
+
+def _write_path_and_query(buf, path, query):
+    """Add the quoted path and query string to `buf`.
+
+    :param klempner.compat.StringIO buf: buffer to write to
+    :param path: request path elements
+    :param dict query: request query parameters
+
+    """
+    buf.write(_encode_path(path))
+    query_string = _encode_query(query)
+    if query_string:
+        buf.write('?')
+        buf.write(query_string)
+
+
+def _encode_path(path):
+    """Quote and join `path` into an absolute path."""
+    return '/' + '/'.join([_quote_path_element(p) for p in path])
+
+
+def _encode_query(query):
+    """Quote and join `query` into a query string.
+
+    :param dict query: request query parameters
+    :returns: the encoded query string without a leading ``?``
+    :rtype: str
+
+    """
+    return _query_encoder.encode(query)
+
+
+def _sort_values(values):
+    """Sort `values` falling back to their string form for mixed types."""
+    try:
+        return sorted(values)
+    except TypeError:
+        return sorted(values, key=str)
+
+
+class _ByteWriter(object):
+    """Write ASCII chunks into a fixed-size writable buffer.
+
+    :param buf: a :class:`bytearray` or writable :class:`memoryview`
+    :param bool growable: extend `buf` when it is full instead of
+        raising :exc:`ValueError`
+
+    """
+
+    __slots__ = ('buf', 'growable', 'position')
+
+    def __init__(self, buf, growable=False):
+        self.buf = buf
+        self.growable = growable
+        self.position = 0
+
+    def write(self, chunk):
+        end = self.position + len(chunk)
+        if end > len(self.buf):
+            if not self.growable:
+                raise ValueError('buffer is too small for the URL')
+            self.buf.extend(bytearray(max(end, 2 * len(self.buf)) -
+                                      len(self.buf)))
+        self.buf[self.position:end] = chunk
+        self.position = end
+
+
+def _write_url_bytes(writer, service, path, query):
+    """Write the ASCII encoded URL for `service` using `writer`."""
+    network_portion = _discover(service)
+    try:
+        prefix = _state.encoded_prefixes[network_portion]
+    except KeyError:
+        prefix = _network_prefix(network_portion).encode('ascii')
+        _state.encoded_prefixes[network_portion] = prefix
+    writer.write(prefix)
+    writer.write(b'/')
+    quote = _quote_path_element.encode
+    for index, element in enumerate(path):
+        if index:
+            writer.write(b'/')
+        writer.write(quote(element))
+    if query:
+        separator = b'?'
+        for name, values in _query_encoder.groups(query):
+            quoted_name = _quote_query_name.encode(name)
+            for value in values:
+                writer.write(separator)
+                writer.write(quoted_name)
+                writer.write(b'=')
+                writer.write(_quote_query_value.encode(value))
+                separator = b'&'
+
+
 def _write_network_portion(buf, service):
     """Add the discovered network portion to `buf`.
 
@@ -128,62 +777,97 @@ def _write_network_portion(buf, service):
     :param str service: name of the service that is being looked up
 
     """
-    env_service = service.upper()
-    discovery_style, parameters = config.get_discovery_details()
-    if discovery_style == config.DiscoveryMethod.CONSUL:
-        buf.write('http://')
-        buf.write(service)
-        buf.write('.service.')
-        buf.write(parameters['datacenter'])
-        buf.write('.consul')
-    elif discovery_style == config.DiscoveryMethod.CONSUL_AGENT:
-        service_info = _state.lookup_consul_service(service)
-        if not service_info:  # service does not exist in consul
-            raise errors.ServiceNotFoundError(service)
-        else:
-            calculated_scheme = config.URL_SCHEME_MAP.get(
-                service_info['ServicePort'], 'http')
-            meta = service_info.get('ServiceMeta', {})
-            buf.write(meta.get('protocol', calculated_scheme))
-            buf.write('://')
-            buf.write(service_info['ServiceName'])
-            buf.write('.service.')
-            buf.write(service_info['Datacenter'])
-            buf.write('.consul:')
-            buf.write(str(service_info['ServicePort']))
-    elif discovery_style == config.DiscoveryMethod.K8S:
-        buf.write('http://')
-        buf.write(service + '.')
-        buf.write(parameters['namespace'])
-        buf.write('.svc.cluster.local')
-    elif discovery_style == config.DiscoveryMethod.ENV_VARS:
-        scheme = os.environ.get('{0}_SCHEME'.format(env_service), None)
-        host = os.environ.get('{0}_HOST'.format(env_service), None)
-        port = os.environ.get('{0}_PORT'.format(env_service), None)
-
-        if port is not None and port.startswith('tcp://'):
-            # special case for docker's ip:port format
-            parts = compat.urlparse(port)
-            port = str(parts.port)
-            if host is None:
-                host = parts.hostname
-        if scheme is None:
-            if port is not None:
-                scheme = config.URL_SCHEME_MAP.get(int(port), 'http')
-            else:
-                scheme = 'http'
-        buf.write(scheme)
-        buf.write('://')
-        buf.write(host or service)
-        if port is not None:
-            buf.write(':')
-            buf.write(port)
-    else:
-        buf.write('http://')
-        buf.write(service)
+    buf.write(_network_prefix(_discover(service)))
+
+
+def _network_prefix(network_portion):
+    """Return the cached URL prefix for `network_portion`.
+
+    :param tuple network_portion: the discovered network details
+    :rtype: str
+
+    The prefix is formatted the first time that a network portion is
+    seen and cached in the module state.  The scheme is
+    part of the key so changes to
+    :data:`klempner.config.URL_SCHEME_MAP` are reflected immediately.
+
+    """
+    try:
+        return _state.network_prefixes[network_portion]
+    except KeyError:
+        prefix = _format_network_portion(network_portion)
+        _state.network_prefixes[network_portion] = prefix
+        return prefix
+
 
+def _format_network_portion(network_portion):
+    """Format a discovered ``(scheme, host, port)`` tuple as a URL prefix.
 
-def _quote_query_arg(v):
-    if not isinstance(v, compat.TEXT_TYPES):
-        v = str(v)
-    return compat.quote(v.encode('utf-8'))
+    :param tuple network_portion: the discovered network details
+    :rtype: str
+
+    """
+    scheme, host, port = network_portion
+    return '{0}://{1}'.format(scheme, _format_authority(host, port))
+
+
+def _format_authority(host, port):
+    """Format `host` and `port` as a URL authority.
+
+    :param str host: host name or IP address
+    :param port: optional port number
+    :rtype: str
+
+    IPv6 addresses are enclosed in brackets.
+
+    """
+    authority = '[{0}]'.format(host) if ':' in host else host
+    if port is None:
+        return authority
+    return '{0}:{1}'.format(authority, port)
+
+
+def _discover(service):
+    """Discover the network location of `service`.
+
+    :param str service: name of the service that is being looked up
+    :returns: a ``(scheme, host, port)`` tuple where `port` is
+        :data:`None` or a string
+    :rtype: tuple
+
+    The result is recorded in the index used by :func:`.identify`.
+
+    """
+    if _check_pid and _state.pid != os.getpid():
+        _after_fork()
+    network_portion = config.get_service_backend(service).resolve(service)
+    _state.index_service(service, network_portion)
+    return network_portion
+
+
+def _at_fork(handler):
+    """Call `handler` in forked child processes.
+
+    :returns: `handler` so that this can be used as a decorator
+
+    """
+    _fork_handlers.append(handler)
+    return handler
+
+
+def _after_fork():
+    """Reinitialize the library state in a forked child process."""
+    _state.after_fork()
+    for backend in config._all_backends():
+        backend.after_fork()
+    for handler in _fork_handlers:
+        handler()
+
+
+# os.register_at_fork is not available before Python 3.7 so fall back
+# to comparing process IDs when discovering services
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+    _check_pid = False
+else:  # pragma: no cover
+    _check_pid = True
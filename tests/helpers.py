@@ -1,4 +1,7 @@
 import os
+import socket
+import struct
+import threading
 import unittest
 try:
     import unittest.mock as mock
@@ -77,3 +80,107 @@ class Interceptor(mock.Mock):
             mock_name = self._extract_mock_name() + attribute
             raise AttributeError(mock_name)
         return mock.Mock(**kwargs)
+
+
+class DNSServer(object):
+    """Stand-in DNS server that answers SRV queries.
+
+    The server listens for UDP and TCP queries on the same loopback
+    port in a background thread.  Add answers to ``self.records`` by
+    fully-qualified name (without the trailing dot) as lists of
+    ``(priority, weight, port, target, ttl)`` tuples.  Names that are
+    not in ``self.records`` are answered with *NXDOMAIN*.  Set
+    ``self.truncate_udp`` to force clients to retry over TCP.
+
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.queries = []
+        self.truncate_udp = False
+        self.udp_socket, self.tcp_socket = self._bind_sockets()
+        self.address = self.udp_socket.getsockname()
+        self.tcp_socket.listen(5)
+        self._threads = [
+            threading.Thread(target=self._serve_udp),
+            threading.Thread(target=self._serve_tcp),
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        self.udp_socket.close()
+        self.tcp_socket.close()
+
+    @staticmethod
+    def _bind_sockets():
+        # The port that is free for UDP may be in use for TCP so keep
+        # trying until both sockets are bound to the same port
+        for _ in range(20):
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_socket.bind(('127.0.0.1', 0))
+            tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                tcp_socket.bind(udp_socket.getsockname())
+            except (OSError, socket.error):
+                udp_socket.close()
+                tcp_socket.close()
+            else:
+                return udp_socket, tcp_socket
+        raise RuntimeError('failed to bind the DNS server sockets')
+
+    def _serve_udp(self):
+        while True:
+            try:
+                data, peer = self.udp_socket.recvfrom(512)
+            except (OSError, socket.error):
+                break
+            self.udp_socket.sendto(
+                self.build_response(data, self.truncate_udp), peer)
+
+    def _serve_tcp(self):
+        while True:
+            try:
+                conn, _ = self.tcp_socket.accept()
+            except (OSError, socket.error):
+                break
+            try:
+                length = struct.unpack('!H', conn.recv(2))[0]
+                response = self.build_response(conn.recv(length), False)
+                conn.sendall(struct.pack('!H', len(response)) + response)
+            finally:
+                conn.close()
+
+    def build_response(self, query, truncate):
+        query_id = struct.unpack('!H', query[:2])[0]
+        offset, labels = 12, []
+        while bytearray(query)[offset]:
+            length = bytearray(query)[offset]
+            labels.append(query[offset + 1:offset + 1 + length].decode())
+            offset += length + 1
+        question = query[12:offset + 5]
+        name = '.'.join(labels)
+        self.queries.append(name)
+
+        records = self.records.get(name)
+        flags = 0x8180
+        if truncate:
+            flags |= 0x0200
+            records = []
+        elif records is None:
+            flags |= 0x0003
+            records = []
+
+        answers = []
+        for priority, weight, port, target, ttl in records:
+            target = b''.join(
+                struct.pack('!B', len(label)) + label.encode()
+                for label in target.split('.')) + b'\0'
+            rdata = struct.pack('!HHH', priority, weight, port) + target
+            answers.append(
+                struct.pack('!HHHIH', 0xC00C, 33, 1, ttl, len(rdata)) + rdata)
+        return b''.join([
+            struct.pack('!HHHHHH', query_id, flags, 1, len(answers), 0, 0),
+            question,
+        ] + answers)
@@ -6,7 +6,7 @@ try:
 except ImportError:
     import mock
 
-from klempner import config, errors, url, version
+from klempner import config, discovery, errors, url, version
 
 import tests.helpers
 
@@ -78,7 +78,7 @@ class ConfigByEnvironTests(tests.helpers.EnvironmentMixin, unittest.TestCase):
         self.setenv('KLEMPNER_DISCOVERY', config.DiscoveryMethod.CONSUL_AGENT)
         self.setenv('CONSUL_AGENT_URL', 'http://127.0.0.1:1')
         self.setenv('CONSUL_HTTP_TOKEN', 'some-token')
-        with mock.patch('klempner.config.requests.get') as requests_get:
+        with mock.patch('klempner.discovery.requests.get') as requests_get:
             response = mock.Mock()
             response.json.return_value = {'Config': {'Datacenter': 'dc1'}}
             requests_get.return_value = response
@@ -95,7 +95,7 @@ class ConfigByEnvironTests(tests.helpers.EnvironmentMixin, unittest.TestCase):
                          'Consul agent is not present')
     def test_that_consul_agent_discovery_includes_user_agent(self):
         self.setenv('KLEMPNER_DISCOVERY', config.DiscoveryMethod.CONSUL_AGENT)
-        with mock.patch('klempner.config.requests.get') as requests_get:
+        with mock.patch('klempner.discovery.requests.get') as requests_get:
             response = mock.Mock()
             response.json.return_value = {'Config': {'Datacenter': 'dc1'}}
             requests_get.return_value = response
@@ -156,3 +156,171 @@ class SchemeMappingTests(tests.helpers.EnvironmentMixin, unittest.TestCase):
         self.setenv('ACCOUNT_PORT', '5672')
         self.assertEqual('rabbitmq://account.example.com:5672/',
                          url.build_url('account'))
+
+
+class StaticBackend(discovery.Backend):
+    name = 'static'
+    required_parameters = ('host', )
+    optional_parameters = {'port': None}
+
+    @classmethod
+    def parameters_from_environment(cls):
+        return {'host': os.environ.get('STATIC_HOST', 'static.example.com')}
+
+    def resolve(self, service):
+        return 'https', self.parameters['host'], self.parameters['port']
+
+
+class BackendRegistryTests(tests.helpers.EnvironmentMixin, unittest.TestCase):
+    def setUp(self):
+        super(BackendRegistryTests, self).setUp()
+        self.addCleanup(discovery._registry.pop, StaticBackend.name, None)
+
+    def tearDown(self):
+        super(BackendRegistryTests, self).tearDown()
+        config.reset()
+
+    def test_that_registered_backend_can_be_configured(self):
+        discovery.register(StaticBackend)
+        config.configure('static', host='10.0.0.1', port='8443')
+        self.assertIsInstance(config.get_discovery_backend(), StaticBackend)
+        self.assertEqual('https://10.0.0.1:8443/path',
+                         url.build_url('account', 'path'))
+
+    def test_that_registered_backend_can_be_configured_from_env(self):
+        discovery.register(StaticBackend)
+        self.setenv('KLEMPNER_DISCOVERY', 'static')
+        self.setenv('STATIC_HOST', '10.0.0.2')
+        self.assertEqual('https://10.0.0.2/', url.build_url('account'))
+
+    def test_that_required_parameters_are_enforced(self):
+        discovery.register(StaticBackend)
+        with self.assertRaises(errors.ConfigurationError) as context:
+            config.configure('static')
+        self.assertEqual('host', context.exception.configuration_name)
+
+    def test_that_backends_are_loaded_from_entry_points(self):
+        with mock.patch('klempner.compat.iter_entry_points') as iter_eps:
+            iter_eps.return_value = [('other', mock.Mock()),
+                                     ('static', lambda: StaticBackend)]
+            config.configure('static', host='10.0.0.3')
+            iter_eps.assert_called_once_with(discovery.ENTRY_POINT_GROUP)
+        self.assertIs(StaticBackend, discovery.get_backend('static'))
+
+    def test_that_builtin_methods_are_registered(self):
+        for method in config.DiscoveryMethod.AVAILABLE:
+            if method is not config.DiscoveryMethod.UNSET:
+                self.assertEqual(method, discovery.get_backend(method).name)
+
+
+class DiscoveryOverrideTests(tests.helpers.EnvironmentMixin,
+                             unittest.TestCase):
+    def setUp(self):
+        super(DiscoveryOverrideTests, self).setUp()
+        discovery.register(StaticBackend)
+        self.addCleanup(discovery._registry.pop, StaticBackend.name, None)
+        self.setenv('POSTGRES_HOST', '10.0.0.5')
+        self.setenv('POSTGRES_PORT', '5432')
+
+    def tearDown(self):
+        super(DiscoveryOverrideTests, self).tearDown()
+        config.reset()
+
+    def test_that_exact_service_override_is_used(self):
+        config.configure(config.DiscoveryMethod.SIMPLE,
+                         overrides={'postgres': 'environment'})
+        self.assertEqual('postgresql://10.0.0.5:5432/',
+                         url.build_url('postgres'))
+        self.assertEqual('http://account/', url.build_url('account'))
+
+    def test_that_patterns_match_services(self):
+        config.configure(config.DiscoveryMethod.SIMPLE, overrides={
+            'internal-*': ('static', {'host': 'internal.example.com'}),
+        })
+        self.assertEqual('https://internal.example.com/',
+                         url.build_url('internal-search'))
+        self.assertEqual('http://external/', url.build_url('external'))
+
+    def test_that_exact_names_beat_longer_patterns(self):
+        config.configure(config.DiscoveryMethod.SIMPLE, overrides=[
+            ('db-*', ('static', {'host': 'short.example.com'})),
+            ('db-primary-*', ('static', {'host': 'long.example.com'})),
+            ('db-primary-1', 'environment'),
+        ])
+        self.assertEqual('https://long.example.com/',
+                         url.build_url('db-primary-2'))
+        self.assertEqual('https://short.example.com/',
+                         url.build_url('db-replica'))
+        self.assertEqual('http://db-primary-1/', url.build_url('db-primary-1'))
+
+    def test_that_pattern_matches_are_remembered(self):
+        config.configure(config.DiscoveryMethod.SIMPLE,
+                         overrides={'internal-*': 'environment'})
+        backend = config.get_service_backend('internal-search')
+        self.assertIs(backend, config._route_cache['internal-search'])
+        self.assertIs(config.get_discovery_backend(),
+                      config.get_service_backend('other'))
+
+    def test_that_reconfiguring_never_caches_the_replaced_backend(self):
+        config.configure(config.DiscoveryMethod.SIMPLE,
+                         overrides={'internal-*': 'environment'})
+        previous = config.get_service_backend('other')
+        compile_overrides = config._compile_overrides
+
+        def compile_and_lookup(override_backends):
+            compile_overrides(override_backends)
+            config.get_service_backend('other')  # concurrent lookup
+
+        with mock.patch('klempner.config._compile_overrides',
+                        side_effect=compile_and_lookup):
+            config.configure(config.DiscoveryMethod.SIMPLE,
+                             overrides={'internal-*': 'environment'})
+        self.assertIsNot(previous, config.get_service_backend('other'))
+        self.assertIs(config.get_discovery_backend(),
+                      config.get_service_backend('other'))
+
+    def test_that_exact_overrides_survive_route_cache_eviction(self):
+        config.configure(config.DiscoveryMethod.SIMPLE, overrides={
+            'postgres': 'environment',
+            'internal-*': ('static', {'host': 'internal.example.com'}),
+        })
+        self.assertEqual('postgresql://10.0.0.5:5432/',
+                         url.build_url('postgres'))
+        for index in range(config._ROUTE_CACHE_SIZE + 10):
+            url.build_url('service-{0}'.format(index))
+        self.assertEqual('postgresql://10.0.0.5:5432/',
+                         url.build_url('postgres'))
+        self.assertEqual('https://internal.example.com/',
+                         url.build_url('internal-search'))
+
+    def test_that_override_requirements_are_enforced(self):
+        with self.assertRaises(errors.ConfigurationError) as context:
+            config.configure(config.DiscoveryMethod.SIMPLE,
+                             overrides={'postgres': 'static'})
+        self.assertEqual('host', context.exception.configuration_name)
+
+    def test_that_reconfiguring_clears_overrides(self):
+        config.configure(config.DiscoveryMethod.SIMPLE,
+                         overrides={'postgres': 'environment'})
+        url.build_url('postgres')
+        config.configure(config.DiscoveryMethod.SIMPLE)
+        self.assertEqual('http://postgres/', url.build_url('postgres'))
+
+    def test_that_overrides_are_read_from_environment(self):
+        self.setenv('KLEMPNER_DISCOVERY', 'simple')
+        self.setenv('KLEMPNER_DISCOVERY_OVERRIDES',
+                    'postgres=environment, internal-*=static,'
+                    'other-*=static')
+        self.setenv('STATIC_HOST', '10.0.0.9')
+        self.assertEqual('postgresql://10.0.0.5:5432/',
+                         url.build_url('postgres'))
+        self.assertEqual('https://10.0.0.9/', url.build_url('internal-api'))
+        self.assertEqual('http://account/', url.build_url('account'))
+        self.assertIs(config.get_service_backend('internal-api'),
+                      config.get_service_backend('other-api'))
+
+    def test_that_malformed_environment_override_fails(self):
+        self.setenv('KLEMPNER_DISCOVERY', 'simple')
+        self.setenv('KLEMPNER_DISCOVERY_OVERRIDES', 'postgres')
+        with self.assertRaises(errors.ConfigurationError):
+            config.configure_from_environment()
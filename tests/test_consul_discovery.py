@@ -1,15 +1,23 @@
 from __future__ import unicode_literals
 
+import json
 import os
 import random
+import threading
 import unittest
 import uuid
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
 
 import requests
 
 import klempner.compat
 import klempner.config
+import klempner.consul
 import klempner.errors
+import klempner.session
 import klempner.url
 
 from tests import helpers
@@ -153,3 +161,640 @@ class AgentBasedTests(helpers.EnvironmentMixin, unittest.TestCase):
                 **service_info),
             klempner.url.build_url(service_info['Name']),
         )
+
+    def test_that_bulk_urls_follow_cache_refresh(self):
+        service_info = self.register_service()
+        urls = klempner.url.build_urls(service_info['Name'], ['1', '2'])
+        self.assertEqual(
+            'http://{Name}.service.{Datacenter}.consul:{Port}/1'.format(
+                **service_info), next(urls))
+
+        self.deregister_service(service_info['ID'])
+        service_info = self.register_service(
+            service_name=service_info['Name'])
+        klempner.url._state.discovery_cache.clear()
+        self.assertEqual(
+            'http://{Name}.service.{Datacenter}.consul:{Port}/2'.format(
+                **service_info), next(urls))
+
+
+class MockedConsulTestCase(helpers.EnvironmentMixin, unittest.TestCase):
+    def setUp(self):
+        super(MockedConsulTestCase, self).setUp()
+        klempner.config.configure(klempner.config.DiscoveryMethod.UNSET)
+        self.setenv('CONSUL_AGENT_URL', 'http://127.0.0.1:8500')
+        self.passing = {}
+        self.critical = {}
+        self.coordinates = []
+        self.instances = {}
+        self.response_headers = {}
+        self.coordinate_error = None
+        patcher = mock.patch('klempner.consul.agent_response',
+                             side_effect=self.consul_response)
+        self.consul_request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        super(MockedConsulTestCase, self).tearDown()
+        klempner.config.configure(klempner.config.DiscoveryMethod.UNSET)
+
+    def consul_response(self, path, datacenter=None, params=(), headers=None):
+        if path == '/v1/coordinate/datacenters':
+            if self.coordinate_error is not None:
+                raise self.coordinate_error
+            body = self.coordinates
+        else:
+            service = path.rpartition('/')[2]
+            datacenter = datacenter or 'dc1'
+            body = [
+                self.health_entry(service, datacenter, node, zone, address)
+                for node, zone, address in self.instances.get(service, [])
+            ]
+            if datacenter in self.passing.get(service, []):
+                body.append(self.health_entry(service, datacenter))
+            if datacenter in self.critical.get(service, []):
+                body.append(self.health_entry(service, datacenter,
+                                              status='critical'))
+            if ('passing', '') in params:
+                body = [
+                    entry for entry in body
+                    if all(check['Status'] == 'passing'
+                           for check in entry['Checks'])
+                ]
+        response = requests.Response()
+        response.status_code = 200
+        response.headers.update(self.response_headers)
+        response._content = json.dumps(body).encode('utf-8')
+        return response
+
+    @staticmethod
+    def health_entry(service, datacenter, node='node1', zone=None,
+                     address='10.0.0.1', status='passing'):
+        return {
+            'Node': {
+                'Node': node,
+                'Address': address,
+                'Datacenter': datacenter,
+                'Meta': {'zone': zone},
+            },
+            'Service': {'Service': service, 'Port': 8000, 'Address': ''},
+            'Checks': [{'CheckID': 'serfHealth', 'Status': status}],
+        }
+
+
+class DatacenterFailoverTests(MockedConsulTestCase):
+    @staticmethod
+    def coordinate(x, y):
+        return {'Vec': [x, y], 'Height': 0.0, 'Adjustment': 0.0}
+
+    def test_that_explicit_datacenters_are_tried_in_order(self):
+        klempner.config.configure(
+            klempner.config.DiscoveryMethod.CONSUL_AGENT, datacenter='dc1',
+            failover_datacenters='dc2, dc3')
+        self.passing['account'] = ['dc3']
+        self.assertEqual('http://account.service.dc3.consul:8000/',
+                         klempner.url.build_url('account'))
+        self.assertEqual(
+            [None, 'dc2', 'dc3'],
+            [kwargs['datacenter']
+             for _, kwargs in self.consul_request.call_args_list])
+
+    def test_that_local_datacenter_is_preferred(self):
+        klempner.config.configure(
+            klempner.config.DiscoveryMethod.CONSUL_AGENT, datacenter='dc1',
+            failover_datacenters=['dc2'])
+        self.passing['account'] = ['dc1', 'dc2']
+        self.assertEqual('http://account.service.dc1.consul:8000/',
+                         klempner.url.build_url('account'))
+        self.assertEqual(1, self.consul_request.call_count)
+
+    def test_that_datacenters_without_passing_instances_are_skipped(self):
+        klempner.config.configure(
+            klempner.config.DiscoveryMethod.CONSUL_AGENT, datacenter='dc1',
+            failover_datacenters=['dc2'])
+        self.critical['account'] = ['dc1']
+        self.passing['account'] = ['dc2']
+        self.assertEqual('http://account.service.dc2.consul:8000/',
+                         klempner.url.build_url('account'))
+        self.assertEqual(
+            [None, 'dc2'],
+            [kwargs['datacenter']
+             for _, kwargs in self.consul_request.call_args_list])
+
+    def test_that_failover_result_is_cached(self):
+        klempner.config.configure(
+            klempner.config.DiscoveryMethod.CONSUL_AGENT, datacenter='dc1',
+            failover_datacenters=['dc2'])
+        self.passing['account'] = ['dc2']
+        klempner.url.build_url('account')
+        klempner.url.build_url('account')
+        self.assertEqual(2, self.consul_request.call_count)
+
+    def test_that_missing_service_raises_not_found(self):
+        klempner.config.configure(
+            klempner.config.DiscoveryMethod.CONSUL_AGENT, datacenter='dc1',
+            failover_datacenters=['dc2'])
+        with self.assertRaises(klempner.errors.ServiceNotFoundError):
+            klempner.url.build_url('account')
+
+    def test_that_nearest_datacenters_are_ordered_by_coordinates(self):
+        self.coordinates = [
+            {'Datacenter': 'dc1', 'Coordinates': [
+                {'Node': 's1', 'Coord': self.coordinate(0.0, 0.0)},
+            ]},
+            {'Datacenter': 'far', 'Coordinates': [
+                {'Node': 's2', 'Coord': self.coordinate(0.3, 0.4)},
+            ]},
+            {'Datacenter': 'near', 'Coordinates': [
+                {'Node': 's3', 'Coord': self.coordinate(0.03, 0.04)},
+                {'Node': 's4', 'Coord': self.coordinate(0.06, 0.08)},
+            ]},
+            {'Datacenter': 'empty', 'Coordinates': []},
+        ]
+        klempner.config.configure(
+            klempner.config.DiscoveryMethod.CONSUL_AGENT, datacenter='dc1',
+            failover_datacenters=klempner.config.NEAREST_DATACENTERS)
+        self.passing['account'] = ['far', 'near']
+        self.assertEqual('http://account.service.near.consul:8000/',
+                         klempner.url.build_url('account'))
+        self.assertEqual(['near', 'far', 'empty'],
+                         klempner.consul.nearest_datacenters('dc1'))
+
+    def test_that_nearest_is_not_calculated_for_local_services(self):
+        klempner.config.configure(
+            klempner.config.DiscoveryMethod.CONSUL_AGENT, datacenter='dc1',
+            failover_datacenters=klempner.config.NEAREST_DATACENTERS)
+        self.passing['account'] = ['dc1']
+        self.assertEqual('http://account.service.dc1.consul:8000/',
+                         klempner.url.build_url('account'))
+        self.assertEqual(
+            ['/v1/health/service/account'],
+            [args[0] for args, _ in self.consul_request.call_args_list])
+
+    def test_that_coordinate_failures_do_not_break_lookups(self):
+        self.coordinate_error = requests.HTTPError('500 Server Error')
+        klempner.config.configure(
+            klempner.config.DiscoveryMethod.CONSUL_AGENT, datacenter='dc1',
+            failover_datacenters=klempner.config.NEAREST_DATACENTERS)
+        self.passing['account'] = ['dc1']
+        self.assertEqual('http://account.service.dc1.consul:8000/',
+                         klempner.url.build_url('account'))
+        with self.assertRaises(klempner.errors.ServiceNotFoundError):
+            klempner.url.build_url('missing')
+
+    def test_that_nearest_requires_agent_url(self):
+        self.unsetenv('CONSUL_AGENT_URL')
+        with self.assertRaises(klempner.errors.ConfigurationError) as context:
+            klempner.config.configure(
+                klempner.config.DiscoveryMethod.CONSUL_DNS, datacenter='dc1',
+                failover_datacenters=klempner.config.NEAREST_DATACENTERS)
+        self.assertEqual('CONSUL_AGENT_URL',
+                         context.exception.configuration_name)
+
+    def test_that_coordinate_distance_applies_adjustments(self):
+        a = {'Vec': [0.0, 0.0], 'Height': 0.001, 'Adjustment': 0.002}
+        b = {'Vec': [0.3, 0.4], 'Height': 0.001, 'Adjustment': -0.001}
+        self.assertAlmostEqual(0.503,
+                               klempner.consul._coordinate_distance(a, b))
+        b['Adjustment'] = -1.0
+        self.assertAlmostEqual(0.502,
+                               klempner.consul._coordinate_distance(a, b))
+
+
+class ConsulQueryOptionsTests(MockedConsulTestCase):
+    def setUp(self):
+        super(ConsulQueryOptionsTests, self).setUp()
+        self.passing['account'] = ['dc1']
+
+    def configure(self, **parameters):
+        klempner.config.configure(
+            klempner.config.DiscoveryMethod.CONSUL_AGENT, datacenter='dc1',
+            **parameters)
+
+    def sent_request(self):
+        klempner.url.build_url('account')
+        _, kwargs = self.consul_request.call_args
+        return kwargs['params'], kwargs['headers']
+
+    def test_that_default_consistency_sends_no_parameters(self):
+        self.configure()
+        self.assertEqual(([('passing', '')], {}), self.sent_request())
+
+    def test_that_consistency_mode_is_sent(self):
+        self.configure(consistency='stale')
+        params, _ = self.sent_request()
+        self.assertEqual([('passing', ''), ('stale', '')], params)
+
+    def test_that_agent_caching_sets_cache_control(self):
+        self.configure(consistency='stale', cache_max_age='30')
+        params, headers = self.sent_request()
+        self.assertEqual([('passing', ''), ('stale', ''), ('cached', '')],
+                         params)
+        self.assertEqual({'Cache-Control': 'max-age=30'}, headers)
+
+    def test_that_tags_and_filter_are_sent(self):
+        self.configure(tags='primary, v2',
+                       filter='Service.Meta.version == "2"')
+        params, _ = self.sent_request()
+        self.assertEqual([('passing', ''), ('tag', 'primary'), ('tag', 'v2'),
+                          ('filter', 'Service.Meta.version == "2"')], params)
+
+    def test_that_invalid_consistency_is_rejected(self):
+        with self.assertRaises(klempner.errors.ConfigurationError) as context:
+            self.configure(consistency='eventual')
+        self.assertEqual('consistency', context.exception.configuration_name)
+
+    def test_that_caching_is_rejected_with_consistent_reads(self):
+        with self.assertRaises(klempner.errors.ConfigurationError) as context:
+            self.configure(consistency='consistent', cache_max_age=5)
+        self.assertEqual('cache_max_age',
+                         context.exception.configuration_name)
+
+    def test_that_invalid_max_age_is_rejected(self):
+        for value in ('soon', -1):
+            with self.assertRaises(klempner.errors.ConfigurationError):
+                self.configure(cache_max_age=value)
+
+    def test_that_environment_configures_query_options(self):
+        self.setenv('KLEMPNER_DISCOVERY', 'consul+agent')
+        self.setenv('CONSUL_CONSISTENCY', 'stale')
+        self.setenv('CONSUL_CACHE_MAX_AGE', '10')
+        self.setenv('CONSUL_SERVICE_TAGS', 'primary')
+        self.setenv('CONSUL_SERVICE_FILTER', 'Node != "bad"')
+        with mock.patch('klempner.discovery.requests.get') as get:
+            get.return_value.json.return_value = {
+                'Config': {'Datacenter': 'dc1'}}
+            klempner.config.configure_from_environment()
+        _, parameters = klempner.config.get_discovery_details()
+        self.assertEqual('stale', parameters['consistency'])
+        self.assertEqual(10, parameters['cache_max_age'])
+        self.assertEqual(('primary', ), parameters['tags'])
+        self.assertEqual('Node != "bad"', parameters['filter'])
+
+    def test_that_response_age_is_recorded(self):
+        self.configure(consistency='stale', cache_max_age=30)
+        self.response_headers = {'X-Consul-LastContact': '1500', 'Age': '7'}
+        backend = klempner.config.get_discovery_backend()
+        record = backend.snapshot('account')
+        self.assertEqual(1.5, record.last_contact)
+        self.assertEqual(7, record.age)
+        self.assertGreaterEqual(record.staleness, 8.5)
+        self.assertLess(record.staleness, 10)
+
+
+class CachedPrefixTests(MockedConsulTestCase):
+    def setUp(self):
+        super(CachedPrefixTests, self).setUp()
+        klempner.config.configure(
+            klempner.config.DiscoveryMethod.CONSUL_AGENT, datacenter='dc1')
+        self.passing['account'] = ['dc1']
+
+    def test_that_prefix_is_formatted_once(self):
+        with mock.patch('klempner.url._format_network_portion',
+                        wraps=klempner.url._format_network_portion) as fmt:
+            klempner.url.build_url('account')
+            klempner.url.build_url('account', 'users')
+            klempner.url.build_url_bytes('account')
+        self.assertEqual(1, fmt.call_count)
+
+    def test_that_scheme_map_changes_apply_to_cached_services(self):
+        self.assertEqual('http://account.service.dc1.consul:8000/',
+                         klempner.url.build_url('account'))
+        with mock.patch.dict(klempner.config.URL_SCHEME_MAP, {8000: 'ws'}):
+            self.assertEqual('ws://account.service.dc1.consul:8000/',
+                             klempner.url.build_url('account'))
+            self.assertEqual(b'ws://account.service.dc1.consul:8000/',
+                             klempner.url.build_url_bytes('account'))
+        self.assertEqual(1, self.consul_request.call_count)
+
+
+class TopologyAwareTests(MockedConsulTestCase):
+    def setUp(self):
+        super(TopologyAwareTests, self).setUp()
+        self.instances['account'] = [
+            ('node1', 'us-east-1a', '10.0.0.1'),
+            ('node2', 'us-east-1a', '10.0.0.2'),
+            ('node3', 'us-east-1b', '10.0.1.1'),
+            ('node4', 'us-east-1b', '10.0.1.2'),
+        ]
+
+    def configure(self, **parameters):
+        klempner.config.configure(
+            klempner.config.DiscoveryMethod.CONSUL_AGENT, datacenter='dc1',
+            topology_aware=True, **parameters)
+
+    def build_hosts(self, count=4):
+        urls = [klempner.url.build_url('account') for _ in range(count)]
+        return set(klempner.compat.urlparse(url).hostname for url in urls)
+
+    def test_that_same_node_instances_are_preferred(self):
+        self.configure(node='node3', zone='us-east-1a')
+        self.assertEqual({'10.0.1.1'}, self.build_hosts())
+
+    def test_that_same_zone_instances_are_used_without_local_node(self):
+        self.configure(node='elsewhere', zone='us-east-1b')
+        self.assertEqual({'10.0.1.1', '10.0.1.2'}, self.build_hosts())
+
+    def test_that_spillover_threshold_widens_selection(self):
+        self.configure(node='node3', zone='us-east-1b', spillover_threshold=3)
+        self.assertEqual({'10.0.0.1', '10.0.0.2', '10.0.1.1', '10.0.1.2'},
+                         self.build_hosts(8))
+
+    def test_that_health_endpoint_requests_passing_instances(self):
+        self.configure(consistency='stale')
+        klempner.url.build_url('account')
+        args, kwargs = self.consul_request.call_args
+        self.assertEqual('/v1/health/service/account', args[0])
+        self.assertEqual([('passing', ''), ('stale', '')], kwargs['params'])
+
+    def test_that_response_age_is_recorded(self):
+        self.configure(consistency='stale', cache_max_age=30)
+        self.response_headers = {'X-Consul-LastContact': '1500', 'Age': '7'}
+        backend = klempner.config.get_discovery_backend()
+        instances = backend.snapshot('account')
+        self.assertEqual(1.5, instances.last_contact)
+        self.assertEqual(7, instances.age)
+        self.assertGreaterEqual(instances.staleness, 8.5)
+        self.assertLess(instances.staleness, 10)
+        self.assertEqual(instances.records[0].fetched_at, instances.fetched_at)
+
+    def test_that_instance_selection_is_cached(self):
+        self.configure(node='node1')
+        self.build_hosts()
+        self.assertEqual(1, self.consul_request.call_count)
+
+    def test_that_missing_service_raises_not_found(self):
+        self.configure()
+        with self.assertRaises(klempner.errors.ServiceNotFoundError):
+            klempner.url.build_url('unknown')
+
+    def test_that_build_urls_spreads_over_instances(self):
+        self.configure(node='elsewhere', zone='us-east-1b')
+        urls = list(klempner.url.build_urls('account', range(4)))
+        self.assertEqual(
+            {'10.0.1.1', '10.0.1.2'},
+            set(klempner.compat.urlparse(url).hostname for url in urls))
+        self.assertEqual(1, self.consul_request.call_count)
+
+    def test_that_sessions_keep_pools_for_each_instance(self):
+        self.addCleanup(klempner.session.reset)
+        self.configure(node='elsewhere', zone='us-east-1b')
+        session = klempner.session.session_for('account')
+        with mock.patch('requests.adapters.HTTPAdapter.close') as close:
+            base_urls = set(session.refresh() for _ in range(4))
+        close.assert_not_called()
+        self.assertEqual({'http://10.0.1.1:8000/', 'http://10.0.1.2:8000/'},
+                         base_urls)
+        self.assertEqual(2, len(session._pools))
+
+    def test_that_ipv6_addresses_are_bracketed(self):
+        self.instances['account'] = [('node1', 'us-east-1a', '2001:db8::1')]
+        self.configure(node='node1')
+        url = klempner.url.build_url('account', 'users')
+        self.assertEqual('http://[2001:db8::1]:8000/users', url)
+        self.assertEqual(['http://[2001:db8::1]:8000/users'],
+                         list(klempner.url.build_urls('account', ['users'])))
+        self.assertEqual(b'http://[2001:db8::1]:8000/users',
+                         klempner.url.build_url_bytes('account', 'users'))
+        self.assertEqual('account', klempner.url.identify(url))
+
+    def test_that_invalid_spillover_threshold_is_rejected(self):
+        with self.assertRaises(klempner.errors.ConfigurationError) as context:
+            self.configure(spillover_threshold=0)
+        self.assertEqual('spillover_threshold',
+                         context.exception.configuration_name)
+
+    def test_that_environment_configures_locality_from_agent(self):
+        self.setenv('KLEMPNER_DISCOVERY', 'consul+agent')
+        self.setenv('CONSUL_TOPOLOGY_AWARE', 'true')
+        self.setenv('CONSUL_ZONE_KEY', 'az')
+        self.setenv('CONSUL_SPILLOVER_THRESHOLD', '2')
+        with mock.patch('klempner.discovery.requests.get') as get:
+            get.return_value.json.return_value = {
+                'Config': {'Datacenter': 'dc1', 'NodeName': 'node1'},
+                'Meta': {'az': 'us-east-1a'},
+            }
+            klempner.config.configure_from_environment()
+        _, parameters = klempner.config.get_discovery_details()
+        self.assertTrue(parameters['topology_aware'])
+        self.assertEqual('node1', parameters['node'])
+        self.assertEqual('us-east-1a', parameters['zone'])
+        self.assertEqual('az', parameters['zone_key'])
+        self.assertEqual(2, parameters['spillover_threshold'])
+
+
+class LoadOnceTests(unittest.TestCase):
+    def test_that_concurrent_misses_are_coalesced(self):
+        state = klempner.url.State()
+        release = threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            release.wait(5)
+            return 'value'
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                state.load_once(state.discovery_cache, 'key', loader)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual(['value'] * 5, results)
+
+    def test_that_none_is_not_cached(self):
+        state = klempner.url.State()
+        loader = mock.Mock(return_value=None)
+        self.assertIsNone(state.load_once(state.discovery_cache, 'k', loader))
+        self.assertIsNone(state.load_once(state.discovery_cache, 'k', loader))
+        self.assertEqual(2, loader.call_count)
+
+
+class ConsulServiceRecordTests(unittest.TestCase):
+    def setUp(self):
+        super(ConsulServiceRecordTests, self).setUp()
+        self.entry = {
+            'ID': str(uuid.uuid4()),
+            'Node': 'node1',
+            'Address': '10.0.0.1',
+            'Datacenter': 'dc1',
+            'TaggedAddresses': {'lan': '10.0.0.1', 'wan': '10.0.0.1'},
+            'NodeMeta': {'consul-network-segment': ''},
+            'ServiceName': 'account',
+            'ServicePort': 443,
+            'ServiceMeta': {},
+            'ServiceWeights': {'Passing': 1, 'Warning': 1},
+        }
+
+    def test_that_network_portion_is_retained(self):
+        record = klempner.consul.ConsulServiceRecord.from_catalog_entry(
+            self.entry)
+        self.assertEqual(('https', 'account.service.dc1.consul', '443'),
+                         record.network_portion)
+        self.assertEqual('account', record.name)
+        self.assertEqual('dc1', record.datacenter)
+        self.assertEqual(443, record.port)
+
+    def test_that_protocol_metadata_sets_scheme(self):
+        self.entry['ServiceMeta'] = {'protocol': 'grpc'}
+        record = klempner.consul.ConsulServiceRecord.from_catalog_entry(
+            self.entry)
+        self.assertEqual(('grpc', 'account.service.dc1.consul', '443'),
+                         record.network_portion)
+
+    def test_that_scheme_map_changes_are_reflected(self):
+        record = klempner.consul.ConsulServiceRecord.from_catalog_entry(
+            self.entry)
+        with mock.patch.dict(klempner.config.URL_SCHEME_MAP, {443: 'wss'}):
+            self.assertEqual('wss', record.network_portion[0])
+        self.assertEqual('https', record.network_portion[0])
+
+    def test_that_missing_freshness_headers_are_none(self):
+        record = klempner.consul.ConsulServiceRecord.from_catalog_entry(
+            self.entry)
+        self.assertIsNone(record.last_contact)
+        self.assertIsNone(record.age)
+        self.assertLess(record.staleness, 1)
+
+    def test_that_ipv6_address_is_bracketed(self):
+        record = klempner.consul.ConsulServiceRecord.from_health_entry({
+            'Node': {'Node': 'node1', 'Address': '10.0.0.1',
+                     'Datacenter': 'dc1', 'Meta': {}},
+            'Service': {'Service': 'account', 'Port': 8000,
+                        'Address': '2001:db8::1'},
+        })
+        self.assertEqual(('http', '2001:db8::1', '8000'),
+                         record.network_portion)
+        self.assertIn('http://[2001:db8::1]:8000', repr(record))
+
+    def test_that_unused_fields_are_dropped(self):
+        record = klempner.consul.ConsulServiceRecord.from_catalog_entry(
+            self.entry)
+        self.assertFalse(hasattr(record, '__dict__'))
+
+
+class ConsulConnectTests(helpers.EnvironmentMixin, unittest.TestCase):
+    def setUp(self):
+        super(ConsulConnectTests, self).setUp()
+        klempner.config.configure(klempner.config.DiscoveryMethod.UNSET)
+        self.setenv('CONSUL_AGENT_URL', 'http://127.0.0.1:8500')
+        self.services = {
+            'web-sidecar-proxy': self.proxy('web-sidecar-proxy', 'web', [
+                {'DestinationName': 'account', 'LocalBindPort': 9191},
+                {'DestinationName': 'search', 'LocalBindPort': 9192,
+                 'LocalBindAddress': '127.0.0.2'},
+                {'DestinationName': 'socket',
+                 'LocalBindSocketPath': '/tmp/socket'},
+            ]),
+            'web': {'Kind': '', 'ID': 'web', 'Service': 'web'},
+        }
+        self.updates = []
+        self.watching = threading.Event()
+        self.released = threading.Event()
+        self.addCleanup(self.released.set)
+        patcher = mock.patch('klempner.consul.agent_response',
+                             side_effect=self.consul_response)
+        self.consul_response = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        super(ConsulConnectTests, self).tearDown()
+        klempner.config.configure(klempner.config.DiscoveryMethod.UNSET)
+
+    @staticmethod
+    def proxy(proxy_id, destination, upstreams):
+        return {
+            'Kind': 'connect-proxy',
+            'ID': proxy_id,
+            'Service': proxy_id,
+            'Proxy': {
+                'DestinationServiceName': destination,
+                'Upstreams': upstreams,
+            },
+        }
+
+    def consul_response(self, path, datacenter=None, params=(), headers=None,
+                        timeout=None):
+        response = requests.Response()
+        response.status_code = 200
+        if path == '/v1/agent/services':
+            body = self.services
+        else:
+            params = dict(params)
+            if 'hash' in params:
+                if self.updates:
+                    self.services['web-sidecar-proxy'] = self.updates.pop(0)
+                else:
+                    self.watching.set()
+                    self.released.wait(5)
+            body = self.services[path.rpartition('/')[2]]
+            response.headers['X-Consul-ContentHash'] = str(
+                len(body['Proxy']['Upstreams']))
+        response._content = json.dumps(body).encode('utf-8')
+        return response
+
+    def configure(self, **parameters):
+        klempner.config.configure(
+            klempner.config.DiscoveryMethod.CONSUL_CONNECT, **parameters)
+
+    def test_that_upstreams_are_loopback_urls(self):
+        self.configure()
+        self.assertEqual('http://127.0.0.1:9191/v1/users',
+                         klempner.url.build_url('account', 'v1', 'users'))
+        self.assertEqual('http://127.0.0.2:9192/',
+                         klempner.url.build_url('search'))
+
+    def test_that_unknown_upstreams_raise_not_found(self):
+        self.configure()
+        for service in ('unknown', 'socket'):
+            with self.assertRaises(klempner.errors.ServiceNotFoundError):
+                klempner.url.build_url(service)
+
+    def test_that_upstreams_are_cached(self):
+        self.configure(proxy_id='web-sidecar-proxy')
+        klempner.url.build_url('account')
+        self.assertTrue(self.watching.wait(5))
+        calls = self.consul_response.call_count
+        for _ in range(5):
+            klempner.url.build_url('account')
+        self.assertEqual(calls, self.consul_response.call_count)
+
+    def test_that_blocking_query_updates_upstreams(self):
+        self.updates.append(self.proxy('web-sidecar-proxy', 'web', [
+            {'DestinationName': 'account', 'LocalBindPort': 9300},
+        ]))
+        self.configure(proxy_id='web-sidecar-proxy')
+        klempner.url.build_url('account')
+        self.assertTrue(self.watching.wait(5))
+        self.assertEqual('http://127.0.0.1:9300/',
+                         klempner.url.build_url('account'))
+        _, kwargs = self.consul_response.call_args
+        self.assertIn(('hash', '1'), kwargs['params'])
+
+    def test_that_proxy_is_selected_by_destination(self):
+        self.services['other-sidecar-proxy'] = self.proxy(
+            'other-sidecar-proxy', 'other', [])
+        self.configure(service_name='web')
+        self.assertEqual('http://127.0.0.1:9191/',
+                         klempner.url.build_url('account'))
+
+    def test_that_ambiguous_proxy_fails(self):
+        self.services['other-sidecar-proxy'] = self.proxy(
+            'other-sidecar-proxy', 'other', [])
+        self.configure()
+        with self.assertRaises(klempner.errors.ConfigurationError):
+            klempner.url.build_url('account')
+
+    def test_that_agent_url_is_required(self):
+        self.unsetenv('CONSUL_AGENT_URL')
+        with self.assertRaises(klempner.errors.ConfigurationError) as context:
+            self.configure()
+        self.assertEqual('CONSUL_AGENT_URL',
+                         context.exception.configuration_name)
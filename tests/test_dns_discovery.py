@@ -0,0 +1,398 @@
+from __future__ import unicode_literals
+
+import socket
+import threading
+import time
+import unittest
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+import klempner.config
+import klempner.dns
+import klempner.errors
+import klempner.session
+import klempner.url
+
+from tests import helpers
+
+
+class DNSTestCase(helpers.EnvironmentMixin, unittest.TestCase):
+    def setUp(self):
+        super(DNSTestCase, self).setUp()
+        klempner.config.configure(klempner.config.DiscoveryMethod.UNSET)
+        self.server = helpers.DNSServer()
+        self.addCleanup(self.server.close)
+        self.nameserver = '{0}:{1}'.format(*self.server.address)
+
+    def tearDown(self):
+        super(DNSTestCase, self).tearDown()
+        klempner.config.configure(klempner.config.DiscoveryMethod.UNSET)
+
+
+class ConsulDNSTests(DNSTestCase):
+    def setUp(self):
+        super(ConsulDNSTests, self).setUp()
+        self.setenv('KLEMPNER_DISCOVERY',
+                    klempner.config.DiscoveryMethod.CONSUL_DNS)
+        self.setenv('CONSUL_DATACENTER', 'dc1')
+        self.setenv('CONSUL_DNS_ADDR', self.nameserver)
+
+    def test_that_port_is_taken_from_srv_record(self):
+        self.server.records['_account._tcp.service.dc1.consul'] = [
+            (1, 1, 8000, 'node1.node.dc1.consul', 60),
+        ]
+        self.assertEqual('http://node1.node.dc1.consul:8000/',
+                         klempner.url.build_url('account'))
+
+    def test_that_scheme_is_derived_from_port(self):
+        self.server.records['_rabbit._tcp.service.dc1.consul'] = [
+            (1, 1, 5672, 'node1.node.dc1.consul', 60),
+        ]
+        self.assertEqual('amqp://node1.node.dc1.consul:5672/',
+                         klempner.url.build_url('rabbit'))
+
+    def test_that_missing_service_raises_not_found(self):
+        with self.assertRaises(klempner.errors.ServiceNotFoundError):
+            klempner.url.build_url('account')
+
+    def test_that_records_are_cached_by_ttl(self):
+        self.server.records['_account._tcp.service.dc1.consul'] = [
+            (1, 1, 8000, 'node1.node.dc1.consul', 60),
+        ]
+        klempner.url.build_url('account')
+        klempner.url.build_url('account')
+        self.assertEqual(1, len(self.server.queries))
+
+        later = klempner.dns.time.time() + 61
+        with mock.patch('klempner.dns.time.time') as time:
+            time.return_value = later
+            klempner.url.build_url('account')
+        self.assertEqual(2, len(self.server.queries))
+
+    def test_that_zero_ttl_answers_are_cached_for_min_ttl(self):
+        self.server.records['_account._tcp.service.dc1.consul'] = [
+            (1, 1, 8000, 'node1.node.dc1.consul', 0),
+        ]
+        for _ in range(5):
+            klempner.url.build_url('account')
+        self.assertEqual(1, len(self.server.queries))
+
+        later = klempner.dns.time.time() + klempner.dns.DEFAULT_MIN_TTL + 1
+        with mock.patch('klempner.dns.time.time') as time:
+            time.return_value = later
+            klempner.url.build_url('account')
+        self.assertEqual(2, len(self.server.queries))
+
+    def test_that_min_ttl_is_configurable(self):
+        self.setenv('KLEMPNER_DNS_MIN_TTL', '0')
+        self.server.records['_account._tcp.service.dc1.consul'] = [
+            (1, 1, 8000, 'node1.node.dc1.consul', 0),
+        ]
+        for _ in range(3):
+            klempner.url.build_url('account')
+        self.assertEqual(3, len(self.server.queries))
+
+    def test_that_invalid_min_ttl_is_rejected(self):
+        with self.assertRaises(klempner.errors.ConfigurationError) as context:
+            klempner.config.configure(
+                klempner.config.DiscoveryMethod.CONSUL_DNS, datacenter='dc1',
+                min_ttl=-1)
+        self.assertEqual('min_ttl', context.exception.configuration_name)
+
+    def test_that_stale_answer_is_used_when_nameserver_fails(self):
+        self.server.records['_account._tcp.service.dc1.consul'] = [
+            (1, 1, 8000, 'node1.node.dc1.consul', 60),
+        ]
+        klempner.url.build_url('account')
+
+        later = klempner.dns.time.time() + 61
+        with mock.patch('klempner.dns.time.time') as time, \
+                mock.patch.object(klempner.dns.Resolver, '_query') as query:
+            time.return_value = later
+            query.side_effect = socket.timeout('timed out')
+            self.assertEqual('http://node1.node.dc1.consul:8000/',
+                             klempner.url.build_url('account'))
+            self.assertEqual('http://node1.node.dc1.consul:8000/',
+                             klempner.url.build_url('account'))
+        self.assertEqual(1, query.call_count)
+
+    def test_that_nameserver_failure_raises_discovery_error(self):
+        with mock.patch.object(klempner.dns.Resolver, '_query') as query:
+            query.side_effect = socket.timeout('timed out')
+            with self.assertRaises(klempner.errors.DiscoveryError) as context:
+                klempner.url.build_url('account')
+        self.assertEqual('account', context.exception.service_name)
+
+    def test_that_concurrent_misses_share_one_query(self):
+        entered, release = threading.Event(), threading.Event()
+        records = [klempner.dns.SRVRecord(1, 1, 8000, 'node1', 60)]
+
+        def query(name, rtype):
+            entered.set()
+            release.wait(5)
+            return records
+
+        results = []
+        with mock.patch.object(klempner.dns.Resolver, '_query') as patched:
+            patched.side_effect = query
+            threads = [
+                threading.Thread(target=lambda: results.append(
+                    klempner.url.build_url('account')))
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            entered.wait(5)
+            time.sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, patched.call_count)
+        self.assertEqual(['http://node1:8000/'] * 5, results)
+
+    def test_that_lowest_priority_records_are_selected(self):
+        self.server.records['_account._tcp.service.dc1.consul'] = [
+            (2, 100, 8000, 'backup.node.dc1.consul', 60),
+            (1, 10, 8000, 'node1.node.dc1.consul', 60),
+            (1, 10, 8000, 'node2.node.dc1.consul', 60),
+        ]
+        urls = set(klempner.url.build_url('account') for _ in range(50))
+        self.assertEqual(
+            set([
+                'http://node1.node.dc1.consul:8000/',
+                'http://node2.node.dc1.consul:8000/',
+            ]), urls)
+
+    def test_that_build_urls_selects_target_per_url(self):
+        self.server.records['_account._tcp.service.dc1.consul'] = [
+            (1, 10, 8000, 'node1.node.dc1.consul', 60),
+            (1, 10, 8000, 'node2.node.dc1.consul', 60),
+        ]
+        prefixes = set(
+            url.rsplit('/', 1)[0]
+            for url in klempner.url.build_urls('account', range(50)))
+        self.assertEqual(
+            set([
+                'http://node1.node.dc1.consul:8000',
+                'http://node2.node.dc1.consul:8000',
+            ]), prefixes)
+
+    def test_that_build_urls_requeries_after_ttl(self):
+        self.server.records['_account._tcp.service.dc1.consul'] = [
+            (1, 1, 8000, 'node1.node.dc1.consul', 60),
+        ]
+        urls = klempner.url.build_urls('account', ['one', 'two'])
+        self.assertEqual('http://node1.node.dc1.consul:8000/one', next(urls))
+
+        self.server.records['_account._tcp.service.dc1.consul'] = [
+            (1, 1, 8000, 'node2.node.dc1.consul', 60),
+        ]
+        later = klempner.dns.time.time() + 61
+        with mock.patch('klempner.dns.time.time') as time:
+            time.return_value = later
+            self.assertEqual('http://node2.node.dc1.consul:8000/two',
+                             next(urls))
+
+    def test_that_sessions_keep_pools_for_each_target(self):
+        self.addCleanup(klempner.session.reset)
+        self.server.records['_account._tcp.service.dc1.consul'] = [
+            (1, 10, 8000, 'node1.node.dc1.consul', 60),
+            (1, 10, 8000, 'node2.node.dc1.consul', 60),
+        ]
+        session = klempner.session.session_for('account')
+        with mock.patch('requests.adapters.HTTPAdapter.close') as close:
+            base_urls = set(session.refresh() for _ in range(50))
+        close.assert_not_called()
+        self.assertEqual(
+            set([
+                'http://node1.node.dc1.consul:8000/',
+                'http://node2.node.dc1.consul:8000/',
+            ]), base_urls)
+        self.assertEqual(2, len(session._pools))
+
+    def test_that_truncated_responses_are_retried_over_tcp(self):
+        self.server.truncate_udp = True
+        self.server.records['_account._tcp.service.dc1.consul'] = [
+            (1, 1, 8000, 'node1.node.dc1.consul', 60),
+        ]
+        self.assertEqual('http://node1.node.dc1.consul:8000/',
+                         klempner.url.build_url('account'))
+
+    def test_that_nameserver_defaults_to_consul_agent(self):
+        klempner.config.configure(klempner.config.DiscoveryMethod.CONSUL_DNS,
+                                  datacenter='dc1')
+        _, parameters = klempner.config.get_discovery_details()
+        self.assertEqual(('127.0.0.1', 8600), parameters['nameserver'])
+
+
+class KubernetesSRVTests(DNSTestCase):
+    def setUp(self):
+        super(KubernetesSRVTests, self).setUp()
+        self.setenv('KLEMPNER_DISCOVERY',
+                    klempner.config.DiscoveryMethod.K8S_SRV)
+        self.setenv('KUBERNETES_DNS_ADDR', self.nameserver)
+        self.unsetenv('KUBERNETES_NAMESPACE')
+        self.unsetenv('KUBERNETES_PORT_NAME')
+
+    def test_that_http_port_is_used_by_default(self):
+        self.server.records[
+            '_http._tcp.account.default.svc.cluster.local'] = [
+                (0, 100, 8080, 'account.default.svc.cluster.local', 30),
+            ]
+        self.assertEqual('http://account.default.svc.cluster.local:8080/',
+                         klempner.url.build_url('account'))
+
+    def test_that_port_name_and_namespace_are_configurable(self):
+        self.setenv('KUBERNETES_NAMESPACE', 'my-team')
+        self.setenv('KUBERNETES_PORT_NAME', 'https')
+        self.server.records[
+            '_https._tcp.account.my-team.svc.cluster.local'] = [
+                (0, 100, 443, 'account.my-team.svc.cluster.local', 30),
+            ]
+        self.assertEqual('https://account.my-team.svc.cluster.local:443/',
+                         klempner.url.build_url('account'))
+
+
+class DNSClientTests(unittest.TestCase):
+    def test_that_addresses_are_parsed(self):
+        self.assertEqual(('10.0.0.1', 53),
+                         klempner.dns.parse_address('10.0.0.1', 53))
+        self.assertEqual(('10.0.0.1', 8600),
+                         klempner.dns.parse_address('10.0.0.1:8600', 53))
+        self.assertEqual(('::1', 53), klempner.dns.parse_address('::1', 53))
+        self.assertEqual(('::1', 8600),
+                         klempner.dns.parse_address('[::1]:8600', 53))
+
+    def test_that_server_errors_raise_dns_error(self):
+        # response header for query 1234 with rcode=SERVFAIL
+        response = (
+            b'\x04\xd2\x81\x82\x00\x01\x00\x00\x00\x00\x00\x00' +
+            klempner.dns.build_query(1234, 'example.com', 33)[12:])
+        with self.assertRaises(klempner.errors.DNSError) as context:
+            klempner.dns.parse_response(response, 1234)
+        self.assertEqual(2, context.exception.rcode)
+
+    def test_that_mismatched_response_is_rejected(self):
+        with self.assertRaises(ValueError):
+            klempner.dns.parse_response(
+                klempner.dns.build_query(1234, 'example.com', 33), 1234)
+
+    def test_that_long_labels_are_rejected(self):
+        with self.assertRaises(ValueError):
+            klempner.dns.encode_name('a' * 64 + '.example.com')
+
+
+class AddressResolutionTests(helpers.EnvironmentMixin, unittest.TestCase):
+    def setUp(self):
+        super(AddressResolutionTests, self).setUp()
+        klempner.config.configure(klempner.config.DiscoveryMethod.K8S,
+                                  namespace='default')
+        klempner.url.enable_address_resolution(ttl=30)
+        self.addCleanup(klempner.url.disable_address_resolution)
+        patcher = mock.patch('klempner.dns.socket.getaddrinfo')
+        self.getaddrinfo = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.getaddrinfo.return_value = [
+            (2, 1, 6, '', ('10.0.0.1', 0)),
+            (2, 1, 6, '', ('10.0.0.2', 0)),
+            (10, 1, 6, '', ('fd00::1', 0, 0, 0)),
+            (2, 1, 6, '', ('10.0.0.1', 0)),
+        ]
+
+    def tearDown(self):
+        super(AddressResolutionTests, self).tearDown()
+        klempner.config.reset()
+
+    def test_that_addresses_are_used_round_robin(self):
+        urls = [
+            klempner.url.build_service_url('account', 'path')
+            for _ in range(4)
+        ]
+        self.assertEqual([
+            'http://10.0.0.1/path',
+            'http://10.0.0.2/path',
+            'http://[fd00::1]/path',
+            'http://10.0.0.1/path',
+        ], [str(url) for url in urls])
+        for url in urls:
+            self.assertEqual('account.default.svc.cluster.local',
+                             url.server_name)
+
+    def test_that_resolutions_are_cached(self):
+        klempner.url.build_service_url('account')
+        klempner.url.build_service_url('account')
+        self.assertEqual(1, self.getaddrinfo.call_count)
+
+    def test_that_expired_entries_are_refreshed_in_background(self):
+        klempner.url.build_service_url('account')
+        later = klempner.dns.time.time() + 31
+        started = []
+        with mock.patch('klempner.dns.time.time') as time, \
+                mock.patch('klempner.dns.threading.Thread') as thread:
+            time.return_value = later
+            thread.return_value.start.side_effect = lambda: started.append(1)
+            service_url = klempner.url.build_service_url('account')
+            klempner.url.build_service_url('account')
+
+        self.assertEqual('10.0.0.2', service_url.host)
+        self.assertEqual(1, len(started))
+        refresh = thread.call_args[1]
+        refresh['target'](*refresh['args'])
+        self.assertEqual(2, self.getaddrinfo.call_count)
+
+    def test_that_failed_refresh_keeps_stale_addresses(self):
+        cache = klempner.dns.AddressCache(ttl=30)
+        self.assertEqual(['10.0.0.1', '10.0.0.2', 'fd00::1'],
+                         cache.addresses('example.com', 80))
+        self.getaddrinfo.side_effect = klempner.dns.socket.gaierror()
+        cache._refresh(('example.com', 80))
+        self.assertEqual(['10.0.0.1', '10.0.0.2', 'fd00::1'],
+                         cache.addresses('example.com', 80))
+
+    def test_that_build_url_is_unaffected(self):
+        self.assertEqual('http://account.default.svc.cluster.local/',
+                         klempner.url.build_url('account'))
+
+
+class ConsulDNSFailoverTests(DNSTestCase):
+    def setUp(self):
+        super(ConsulDNSFailoverTests, self).setUp()
+        klempner.config.configure(klempner.config.DiscoveryMethod.CONSUL_DNS,
+                                  datacenter='dc1',
+                                  nameserver=self.nameserver,
+                                  failover_datacenters=['dc2', 'dc3'])
+
+    def test_that_datacenters_are_tried_in_order(self):
+        self.server.records['_account._tcp.service.dc3.consul'] = [
+            (1, 1, 8000, 'node1.node.dc3.consul', 60),
+        ]
+        self.assertEqual('http://node1.node.dc3.consul:8000/',
+                         klempner.url.build_url('account'))
+        self.assertEqual([
+            '_account._tcp.service.dc1.consul',
+            '_account._tcp.service.dc2.consul',
+            '_account._tcp.service.dc3.consul',
+        ], self.server.queries)
+
+    def test_that_failover_datacenters_are_calculated_lazily(self):
+        self.setenv('CONSUL_AGENT_URL', 'http://127.0.0.1:8500')
+        klempner.config.configure(
+            klempner.config.DiscoveryMethod.CONSUL_DNS, datacenter='dc1',
+            nameserver=self.nameserver,
+            failover_datacenters=klempner.config.NEAREST_DATACENTERS)
+        self.server.records['_account._tcp.service.dc1.consul'] = [
+            (1, 1, 8000, 'node1.node.dc1.consul', 60),
+        ]
+        with mock.patch('klempner.consul.nearest_datacenters') as nearest:
+            klempner.url.build_url('account')
+        nearest.assert_not_called()
+
+    def test_that_empty_answers_are_cached(self):
+        self.server.records['_account._tcp.service.dc2.consul'] = [
+            (1, 1, 8000, 'node1.node.dc2.consul', 60),
+        ]
+        klempner.url.build_url('account')
+        klempner.url.build_url('account')
+        self.assertEqual(2, len(self.server.queries))
@@ -0,0 +1,151 @@
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+import klempner.config
+import klempner.errors
+import klempner.url
+from tests import helpers
+
+
+class FileDiscoveryTests(helpers.EnvironmentMixin, unittest.TestCase):
+    def setUp(self):
+        super(FileDiscoveryTests, self).setUp()
+        klempner.config.configure(klempner.config.DiscoveryMethod.UNSET)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'services.json')
+        self.write_json({
+            'account': {'scheme': 'https', 'host': 'account.example.com'},
+            'database': {'host': '10.0.0.5', 'port': 5432},
+            'search': {},
+        })
+
+    def tearDown(self):
+        super(FileDiscoveryTests, self).tearDown()
+        klempner.config.configure(klempner.config.DiscoveryMethod.UNSET)
+
+    def write_json(self, services, path=None):
+        path = path or self.path
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as service_file:
+            json.dump(services, service_file)
+        os.rename(temporary, path)
+
+    def configure(self, **parameters):
+        parameters.setdefault('path', self.path)
+        klempner.config.configure(klempner.config.DiscoveryMethod.FILE,
+                                  **parameters)
+
+    def test_that_services_are_read_from_json(self):
+        self.configure()
+        self.assertEqual('https://account.example.com/',
+                         klempner.url.build_url('account'))
+        self.assertEqual('postgresql://10.0.0.5:5432/',
+                         klempner.url.build_url('database'))
+        self.assertEqual('http://search/', klempner.url.build_url('search'))
+
+    def test_that_scheme_map_changes_apply_to_loaded_services(self):
+        self.configure()
+        with mock.patch.dict(klempner.config.URL_SCHEME_MAP,
+                             {5432: 'postgres'}):
+            self.assertEqual('postgres://10.0.0.5:5432/',
+                             klempner.url.build_url('database'))
+        self.assertEqual('postgresql://10.0.0.5:5432/',
+                         klempner.url.build_url('database'))
+
+    def test_that_services_are_read_from_ini(self):
+        path = os.path.join(self.directory, 'services.ini')
+        with open(path, 'w') as service_file:
+            service_file.write('[account]\nhost = 10.0.0.1\nport = 8443\n'
+                               'scheme = https\n')
+        self.configure(path=path)
+        self.assertEqual('https://10.0.0.1:8443/',
+                         klempner.url.build_url('account'))
+
+    def write_ini(self, content):
+        path = os.path.join(self.directory, 'services.ini')
+        with open(path + '.tmp', 'w') as service_file:
+            service_file.write(content)
+        os.rename(path + '.tmp', path)
+        return path
+
+    def test_that_ini_values_are_not_interpolated(self):
+        path = self.write_ini('[account]\nhost = fe80::1%eth0\nport = 8000\n')
+        self.configure(path=path)
+        self.assertEqual('http://[fe80::1%eth0]:8000/',
+                         klempner.url.build_url('account'))
+
+    def test_that_malformed_ini_fails_configuration(self):
+        path = self.write_ini('host = 10.0.0.1\n')
+        with self.assertRaises(klempner.errors.ConfigurationError) as context:
+            self.configure(path=path)
+        self.assertEqual('path', context.exception.configuration_name)
+
+    def test_that_malformed_ini_update_keeps_previous_services(self):
+        path = self.write_ini('[account]\nhost = 10.0.0.1\n')
+        self.configure(path=path, check_interval=0)
+        for content in ('host = 10.0.0.2\n',
+                        '[account]\nhost = 10.0.0.2\n  continued\n= x\n'):
+            self.write_ini(content)
+            self.assertEqual('http://10.0.0.1/',
+                             klempner.url.build_url('account'))
+
+    def test_that_unknown_service_raises_not_found(self):
+        self.configure()
+        with self.assertRaises(klempner.errors.ServiceNotFoundError):
+            klempner.url.build_url('unknown')
+
+    def test_that_missing_file_fails_configuration(self):
+        with self.assertRaises(klempner.errors.ConfigurationError) as context:
+            self.configure(path=os.path.join(self.directory, 'missing.json'))
+        self.assertEqual('path', context.exception.configuration_name)
+
+    def test_that_file_is_not_checked_within_interval(self):
+        self.configure(check_interval=60)
+        with mock.patch('klempner.discovery.os.stat') as stat:
+            for _ in range(10):
+                klempner.url.build_url('account')
+        stat.assert_not_called()
+
+    def test_that_replaced_file_is_reloaded(self):
+        self.configure(check_interval=0)
+        self.write_json({'account': {'host': 'new.example.com'}})
+        self.assertEqual('http://new.example.com/',
+                         klempner.url.build_url('account'))
+
+    def test_that_invalid_update_keeps_previous_services(self):
+        self.configure(check_interval=0)
+        with open(self.path, 'w') as service_file:
+            service_file.write('{not json')
+        self.assertEqual('https://account.example.com/',
+                         klempner.url.build_url('account'))
+
+    def test_that_reload_happens_after_interval(self):
+        self.configure(check_interval=60)
+        self.write_json({'account': {'host': 'new.example.com'}})
+        self.assertEqual('https://account.example.com/',
+                         klempner.url.build_url('account'))
+        later = time.time() + 61
+        with mock.patch('klempner.discovery.time.time', return_value=later):
+            self.assertEqual('http://new.example.com/',
+                             klempner.url.build_url('account'))
+
+    def test_that_environment_configures_file_discovery(self):
+        self.setenv('KLEMPNER_DISCOVERY', 'file')
+        self.setenv('KLEMPNER_SERVICE_FILE', self.path)
+        self.setenv('KLEMPNER_SERVICE_FILE_INTERVAL', '30')
+        klempner.config.configure_from_environment()
+        method, parameters = klempner.config.get_discovery_details()
+        self.assertEqual(klempner.config.DiscoveryMethod.FILE, method)
+        self.assertEqual(30.0, parameters['check_interval'])
+        self.assertEqual('json', parameters['file_format'])
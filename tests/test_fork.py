@@ -0,0 +1,83 @@
+from __future__ import unicode_literals
+
+import json
+import os
+import unittest
+
+import klempner.config
+import klempner.session
+import klempner.url
+from tests import helpers
+
+
+class AfterForkTests(helpers.EnvironmentMixin, unittest.TestCase):
+    def setUp(self):
+        super(AfterForkTests, self).setUp()
+        klempner.config.configure(klempner.config.DiscoveryMethod.UNSET)
+        self.setenv('KLEMPNER_DISCOVERY',
+                    klempner.config.DiscoveryMethod.ENV_VARS)
+        self.setenv('ACCOUNT_HOST', '10.2.12.23')
+
+    def tearDown(self):
+        super(AfterForkTests, self).tearDown()
+        klempner.session.reset()
+        klempner.url.disable_address_resolution()
+        klempner.config.configure(klempner.config.DiscoveryMethod.UNSET)
+
+    def test_that_sessions_and_locks_are_replaced(self):
+        state = klempner.url._state
+        state.discovery_cache['account'] = 'warmed'
+        session, lock = state.session, state._loading_lock
+        klempner.url._after_fork()
+        self.assertIsNot(session, state.session)
+        self.assertIsNot(lock, state._loading_lock)
+        self.assertEqual('warmed', state.discovery_cache['account'])
+
+    def test_that_service_sessions_drop_inherited_pools(self):
+        session = klempner.session.session_for('account')
+        session.refresh()
+        adapter = session.get_adapter(session.base_url)
+        klempner.url._after_fork()
+        self.assertIsNone(session.base_url)
+        self.assertIsNot(adapter, session.get_adapter('http://10.2.12.23/'))
+        self.assertEqual('http://10.2.12.23/', session.refresh())
+        self.assertIs(session, klempner.session.session_for('account'))
+
+    def test_that_address_cache_refreshes_are_forgotten(self):
+        klempner.url.enable_address_resolution()
+        cache = klempner.url._state.address_cache
+        cache._refreshing.add(('account', None))
+        klempner.url._after_fork()
+        self.assertEqual(set(), cache._refreshing)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_that_forked_child_starts_with_warm_cache(self):
+        klempner.url.build_url('account')
+        parent_session = klempner.url._state.session
+        klempner.url._state.discovery_cache['warm'] = 'value'
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                os.close(read_fd)
+                state = klempner.url._state
+                result = {'url': klempner.url.build_url('account')}
+                result['pid'] = state.pid == os.getpid()
+                result['session'] = state.session is not parent_session
+                result['cache'] = state.discovery_cache.get('warm')
+                os.write(write_fd, json.dumps(result).encode('utf-8'))
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as pipe:
+            result = json.loads(pipe.read().decode('utf-8'))
+        os.waitpid(pid, 0)
+        self.assertEqual(
+            {
+                'pid': True,
+                'session': True,
+                'cache': 'value',
+                'url': 'http://10.2.12.23/',
+            }, result)
@@ -0,0 +1,154 @@
+from __future__ import unicode_literals
+
+import itertools
+import time
+import unittest
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+import requests.adapters
+
+import klempner
+import klempner.config
+import klempner.discovery
+import klempner.session
+
+from tests import helpers
+
+
+class RotatingBackend(klempner.discovery.Backend):
+    name = 'rotating'
+    required_parameters = ('hosts', )
+
+    def __init__(self, **parameters):
+        super(RotatingBackend, self).__init__(**parameters)
+        self._hosts = itertools.cycle(self.parameters['hosts'])
+
+    def resolve(self, service):
+        return 'http', next(self._hosts), '8000'
+
+
+class ServiceSessionTests(helpers.EnvironmentMixin, unittest.TestCase):
+    def setUp(self):
+        super(ServiceSessionTests, self).setUp()
+        klempner.config.configure(klempner.config.DiscoveryMethod.ENV_VARS)
+        self.setenv('ACCOUNT_HOST', '10.2.12.23')
+        self.setenv('ACCOUNT_PORT', '8000')
+        patcher = mock.patch.object(requests.adapters.HTTPAdapter, 'send')
+        self.send = patcher.start()
+        self.send.side_effect = self.fake_send
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def fake_send(request, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        response.url = request.url
+        return response
+
+    def tearDown(self):
+        super(ServiceSessionTests, self).tearDown()
+        klempner.session.reset()
+        klempner.config.reset()
+
+    def test_that_session_is_shared_per_service(self):
+        session = klempner.session_for('account')
+        self.assertIs(session, klempner.session_for('account'))
+        self.assertIsNot(session, klempner.session_for('other'))
+
+    def test_that_relative_urls_use_discovered_base(self):
+        session = klempner.session_for('account')
+        session.get('accounts/1234')
+        request = self.send.call_args[0][0]
+        self.assertEqual('http://10.2.12.23:8000/accounts/1234', request.url)
+        session.get('/accounts/1234')
+        request = self.send.call_args[0][0]
+        self.assertEqual('http://10.2.12.23:8000/accounts/1234', request.url)
+
+    def test_that_absolute_urls_are_untouched(self):
+        session = klempner.session_for('account')
+        session.get('http://example.com/')
+        request = self.send.call_args[0][0]
+        self.assertEqual('http://example.com/', request.url)
+
+    def test_that_pool_survives_unchanged_discovery(self):
+        session = klempner.session_for('account')
+        session.get('one')
+        adapter = session.get_adapter(session.base_url)
+        session.get('two')
+        self.assertIs(adapter, session.get_adapter(session.base_url))
+
+    def test_that_new_pool_is_created_when_service_moves(self):
+        session = klempner.session_for('account')
+        session.get('one')
+        adapter = session.get_adapter(session.base_url)
+
+        self.setenv('ACCOUNT_HOST', '10.2.12.24')
+        with mock.patch.object(adapter, 'close') as close:
+            session.get('two')
+        request = self.send.call_args[0][0]
+        self.assertEqual('http://10.2.12.24:8000/two', request.url)
+        self.assertIsNot(adapter, session.get_adapter(session.base_url))
+        close.assert_not_called()
+
+    def test_that_idle_pools_are_retired(self):
+        session = klempner.session_for('account')
+        session.get('one')
+        self.assertIn('http://10.2.12.23:8000/', session.adapters)
+
+        self.setenv('ACCOUNT_HOST', '10.2.12.24')
+        later = time.time() + klempner.session.POOL_IDLE_TIMEOUT + 1
+        with mock.patch('klempner.session.time.time', return_value=later):
+            session.get('two')
+        self.assertNotIn('http://10.2.12.23:8000/', session.adapters)
+        self.assertIn('http://10.2.12.24:8000/', session.adapters)
+
+    def test_that_pools_are_kept_per_instance(self):
+        klempner.discovery.register(RotatingBackend)
+        self.addCleanup(klempner.discovery._registry.pop,
+                        RotatingBackend.name, None)
+        klempner.config.configure('rotating',
+                                  hosts=('10.0.0.1', '10.0.0.2', '10.0.0.3'))
+        session = klempner.session_for('account')
+        with mock.patch.object(requests.adapters.HTTPAdapter,
+                               'close') as close:
+            for _ in range(9):
+                session.get('accounts')
+        close.assert_not_called()
+
+        self.assertEqual(
+            ['http://10.0.0.1:8000/accounts', 'http://10.0.0.2:8000/accounts',
+             'http://10.0.0.3:8000/accounts'] * 3,
+            [args[0].url for args, _ in self.send.call_args_list])
+        adapters = set(
+            id(session.get_adapter('http://10.0.0.{0}:8000/'.format(n)))
+            for n in range(1, 4))
+        self.assertEqual(3, len(adapters))
+        self.assertEqual(3, len(session._pools))
+
+    def test_that_pool_count_is_limited(self):
+        klempner.discovery.register(RotatingBackend)
+        self.addCleanup(klempner.discovery._registry.pop,
+                        RotatingBackend.name, None)
+        hosts = ['10.0.1.{0}'.format(n)
+                 for n in range(klempner.session.MAX_INSTANCE_POOLS + 5)]
+        klempner.config.configure('rotating', hosts=hosts)
+        session = klempner.session_for('account')
+        for _ in hosts:
+            session.refresh()
+        self.assertEqual(klempner.session.MAX_INSTANCE_POOLS,
+                         len(session._pools))
+        self.assertIn('http://{0}:8000/'.format(hosts[-1]), session.adapters)
+
+    def test_that_pool_size_is_configurable(self):
+        session = klempner.session_for('account', pool_maxsize=3)
+        session.get('one')
+        adapter = session.get_adapter(session.base_url)
+        self.assertEqual(3, adapter._pool_maxsize)
+
+        klempner.session_for('account', pool_maxsize=5)
+        adapter = session.get_adapter(session.base_url)
+        self.assertEqual(5, adapter._pool_maxsize)